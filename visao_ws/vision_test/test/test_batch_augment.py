@@ -0,0 +1,83 @@
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from vision_test.utils.datasets import BatchAugment, augment_hsv
+from vision_test.utils.general import xywh2xyxy
+
+HYP = {'degrees': 0.0, 'translate': 0.0, 'scale': 0.0, 'shear': 0.0, 'perspective': 0.0, 'mixup': 0.0,
+       'hsv_h': 0.0, 'hsv_s': 0.0, 'hsv_v': 0.0, 'flipud': 0.0, 'fliplr': 0.0}
+
+
+def box_batch(bs=4, s=64):
+    # Gray 2s x 2s canvases with one white box near the center, targets(n,6) [image, class, xywh normalized]
+    imgs = torch.full((bs, 3, 2 * s, 2 * s), 114 / 255)
+    targets = torch.zeros(bs, 6)
+    for i in range(bs):
+        x1, y1, x2, y2 = s - 12 + i, s - 8, s + 8 + i, s + 10 + 2 * i
+        imgs[i, :, y1:y2, x1:x2] = 1.0
+        xywh = (x1 + x2) / 2, (y1 + y2) / 2, x2 - x1, y2 - y1
+        targets[i] = torch.tensor([i, i % 2, *xywh]) / torch.tensor([1, 1, 2 * s, 2 * s, 2 * s, 2 * s])
+    return imgs, targets
+
+
+def assert_boxes_match(imgs, targets, tol=2.0):
+    # Every label covers the white pixels of its image
+    s = imgs.shape[-1]
+    for t in targets:
+        y, x = (imgs[int(t[0])].mean(0) > 0.75).nonzero(as_tuple=True)
+        box = xywh2xyxy(t[None, 2:])[0] * s
+        white = torch.stack((x.min(), y.min(), x.max() + 1, y.max() + 1)).float()
+        assert (box - white).abs().max() < tol, (box, white)
+
+
+@pytest.mark.parametrize('hyp', [{}, {'degrees': 10.0, 'translate': 0.1, 'scale': 0.5},
+                                 {'fliplr': 1.0}, {'flipud': 1.0, 'fliplr': 0.5, 'scale': 0.3}])
+def test_batch_augment_labels_follow_image(hyp):
+    torch.manual_seed(0)
+    imgs, targets = box_batch()
+    imgs, targets = BatchAugment({**HYP, **hyp})(imgs, targets)
+    assert imgs.shape == (4, 3, 64, 64) and len(targets) == 4
+    assert targets[:, 1].tolist() == [0, 1, 0, 1]
+    assert_boxes_match(imgs, targets)
+
+
+def test_batch_augment_flip():
+    imgs, targets = box_batch()
+    imgs, targets = imgs[..., :64, :64].clone(), targets.clone()
+    flipped, t = BatchAugment({**HYP, 'fliplr': 1.0}).flip(imgs.clone(), targets.clone())
+    assert torch.equal(flipped, imgs.flip(3))
+    assert torch.allclose(t[:, 2], 1 - targets[:, 2]) and torch.equal(t[:, 3:], targets[:, 3:])
+
+
+def test_batch_augment_mixup():
+    torch.manual_seed(0)
+    imgs, targets = box_batch()
+    _, t = BatchAugment({**HYP, 'mixup': 1.0}).mixup(imgs, targets.clone())
+    assert len(t) == 2 * len(targets)
+    assert torch.equal(t[4:, 0], (targets[:, 0] + 1) % 4)  # image i gets the labels of image i - 1
+    assert torch.equal(t[4:, 1:], targets[:, 1:])
+
+
+@pytest.mark.parametrize('u', [(1, 0, 0), (-1, 0, 0), (0.5, 1, -1), (-0.2, -1, 1)])
+def test_batch_augment_hsv_matches_augment_hsv(monkeypatch, u):
+    # Same gains into both, over a hue sweep that includes the red and magenta sectors
+    hsv = np.stack(np.meshgrid(np.arange(0, 180, 3), [120, 250], [90, 230]), -1).reshape(1, -1, 3).astype(np.uint8)
+    bgr = np.concatenate((cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR), [[[200, 40, 230], [40, 40, 230]]]), 1).astype(np.uint8)
+    gain = {'hsv_h': 0.3, 'hsv_s': 0.4, 'hsv_v': 0.2}
+    monkeypatch.setattr(np.random, 'uniform', lambda *args: np.array(u, dtype=np.float64))
+    monkeypatch.setattr(torch, 'rand', lambda *args: (torch.tensor([u], dtype=torch.float32) + 1) / 2)
+    ref = bgr.copy()
+    augment_hsv(ref, *gain.values())
+    img = torch.from_numpy(bgr[..., ::-1].copy()).permute(2, 0, 1)[None].float() / 255  # BGR to RGB
+    out = BatchAugment({**HYP, **gain}).hsv(img)[0].permute(1, 2, 0).numpy()[..., ::-1] * 255
+    assert np.abs(out - ref).max() < 10  # uint8 HSV quantisation of augment_hsv (2 degree hue steps)
+
+
+def test_batch_augment_hsv_range():
+    torch.manual_seed(0)
+    imgs = torch.rand(4, 3, 16, 16)
+    assert BatchAugment(HYP).hsv(imgs) is imgs  # no gains, no change
+    out = BatchAugment({**HYP, 'hsv_h': 0.015, 'hsv_s': 0.7, 'hsv_v': 0.4}).hsv(imgs)
+    assert out.shape == imgs.shape and out.min() >= 0 and out.max() <= 1
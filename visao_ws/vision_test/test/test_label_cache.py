@@ -0,0 +1,50 @@
+import os
+
+import cv2
+import numpy as np
+
+from vision_test.utils.datasets import LoadImagesAndLabels, load_label_cache, save_label_cache
+
+
+def test_label_cache_round_trip(tmp_path):
+    entries = {'a.jpg': (np.array([[0, .5, .5, .2, .2]], np.float32), (64, 48), [np.ones((3, 2), np.float32)], 0,
+                         (1, 2, 3, 4)),
+               'b.jpg': (np.zeros((0, 5), np.float32), (32, 32), [], 2, (5, 6, -1, -1))}
+    f = tmp_path / 'labels.cache'
+    save_label_cache(f, entries, 0.2)
+    x = load_label_cache(f, 0.2)
+    assert list(x) == list(entries)
+    for k, (l, shape, segments, status, stat) in entries.items():
+        assert np.array_equal(x[k][0], l) and x[k][1] == shape and x[k][3] == status
+        assert tuple(x[k][4]) == stat
+        assert len(x[k][2]) == len(segments) and all(np.array_equal(a, b) for a, b in zip(x[k][2], segments))
+    assert load_label_cache(f, 0.3) == {}  # other version
+    assert load_label_cache(tmp_path / 'missing.cache', 0.2) == {}
+    (tmp_path / 'bad.cache').write_bytes(b'not a cache')
+    assert load_label_cache(tmp_path / 'bad.cache', 0.2) == {}
+
+
+def test_label_cache_invalidation(tmp_path):
+    (tmp_path / 'images').mkdir()
+    (tmp_path / 'labels').mkdir()
+    for i in range(4):
+        cv2.imwrite(str(tmp_path / 'images' / f'{i}.jpg'), np.full((48, 64, 3), 114, np.uint8))
+        (tmp_path / 'labels' / f'{i}.txt').write_text(f'{i % 2} 0.5 0.5 0.25 0.25\n')
+    dataset = LoadImagesAndLabels(str(tmp_path / 'images'), 64, 2)
+    cache_path = tmp_path / 'labels.cache'
+    assert cache_path.exists()
+    assert [tuple(x) for x in dataset.shapes] == [(64, 48)] * 4
+
+    x, current = dataset.cache_labels(cache_path)
+    assert current and x['results'] == (4, 0, 0, 0, 4)
+
+    lb = tmp_path / 'labels' / '1.txt'  # modified label file
+    lb.write_text('1 0.5 0.5 0.25 0.25\n0 0.2 0.2 0.1 0.1\n')
+    os.utime(lb, ns=(lb.stat().st_atime_ns, lb.stat().st_mtime_ns + 10 ** 9))
+    x, current = dataset.cache_labels(cache_path)
+    assert not current and len(x[str(tmp_path / 'images' / '1.jpg')][0]) == 2
+    assert dataset.cache_labels(cache_path)[1]  # saved again
+
+    os.remove(tmp_path / 'labels' / '2.txt')  # missing label file
+    x, current = dataset.cache_labels(cache_path)
+    assert not current and x['results'] == (3, 1, 0, 0, 4)
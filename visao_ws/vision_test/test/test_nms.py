@@ -0,0 +1,87 @@
+import pytest
+import torch
+
+from vision_test.utils.general import NMS_DEFAULT, NMS_ENGINES, merge_tiles, non_max_suppression, \
+    non_max_suppression_batched
+
+
+def boxes_scores(n=300, seed=0):
+    # Clusters of ~10 jittered boxes per object, xyxy pixels and scores
+    g = torch.Generator().manual_seed(seed)
+    xy = torch.rand(n // 10 + 1, 2, generator=g).repeat(10, 1)[:n] * 640
+    xy += torch.randn(n, 2, generator=g) * 8
+    boxes = torch.cat((xy, xy + torch.rand(n, 2, generator=g) * 80 + 4), 1)
+    return boxes, torch.rand(n, generator=g)
+
+
+def prediction(bs=3, n=2000, nc=4, seed=0):
+    # Raw (bs,n,5+nc) model output, xywh pixels, objectness and class scores
+    g = torch.Generator().manual_seed(seed)
+    p = torch.rand(bs, n, 5 + nc, generator=g)
+    p[..., :2] *= 320
+    p[..., 2:4] = p[..., 2:4] * 60 + 4
+    p[..., 4] **= 2
+    return p
+
+
+def test_greedy_engines_match():
+    boxes, scores = boxes_scores()
+    ref = NMS_ENGINES[NMS_DEFAULT](boxes, scores.clone(), 0.45)
+    for k in 'cluster', 'numpy':  # both give the greedy NMS result
+        i = NMS_ENGINES[k](boxes, scores.clone(), 0.45)
+        assert i.tolist() == ref.tolist(), k
+
+
+def test_fast_nms_subset_of_greedy():
+    boxes, scores = boxes_scores()
+    ref = set(NMS_ENGINES[NMS_DEFAULT](boxes, scores, 0.45).tolist())
+    kept = NMS_ENGINES['fast'](boxes, scores, 0.45)
+    assert set(kept.tolist()) <= ref
+    assert (scores[kept][:-1] >= scores[kept][1:]).all()
+
+
+def test_matrix_nms_decays_scores():
+    boxes, scores = boxes_scores()
+    s = scores.clone()
+    i = NMS_ENGINES['matrix'](boxes, s, 0.45)
+    assert sorted(i.tolist()) == list(range(len(boxes)))  # nothing removed
+    assert (s <= scores + 1e-6).all() and (s < scores - 1e-3).any()
+    assert (s[i][:-1] >= s[i][1:]).all()
+
+
+@pytest.mark.parametrize('engine', list(NMS_ENGINES))
+def test_empty_input(engine):
+    assert len(NMS_ENGINES[engine](torch.zeros(0, 4), torch.zeros(0), 0.45)) == 0
+
+
+@pytest.mark.parametrize('engine', list(NMS_ENGINES))
+@pytest.mark.parametrize('multi_label', [False, True])
+def test_batched_matches_per_image(engine, multi_label):
+    p = prediction()
+    p[1, :, 4] = 0  # an image without candidates
+    a = non_max_suppression(p.clone(), 0.1, 0.6, multi_label=multi_label, engine=engine)
+    b = non_max_suppression_batched(p.clone(), 0.1, 0.6, multi_label=multi_label, engine=engine)
+    assert len(a) == len(b) == p.shape[0]
+    assert len(b[1]) == 0
+    for x, y in zip(a, b):
+        assert x.shape == y.shape
+        assert torch.allclose(x, y)
+
+
+def test_batched_agnostic_and_classes():
+    p = prediction()
+    for kw in {'agnostic': True}, {'classes': [1, 3]}:
+        a = non_max_suppression(p.clone(), 0.1, 0.6, **kw)
+        b = non_max_suppression_batched(p.clone(), 0.1, 0.6, **kw)
+        assert all(torch.allclose(x, y) for x, y in zip(a, b))
+    assert all(set(x[:, 5].tolist()) <= {1, 3} for x in b)
+
+
+@pytest.mark.parametrize('engine', list(NMS_ENGINES))
+def test_merge_tiles(engine):
+    # The same ball seen by two overlapping tiles is merged, another class at the same place is kept
+    pred = [torch.tensor([[40., 10., 60., 30., .9, 0.]]),
+            torch.tensor([[1., 10., 21., 30., .8, 0.], [0., 10., 20., 30., .7, 1.]])]
+    x = merge_tiles(pred, [(0, 0), (40, 0)], 0.45, engine=engine, conf_thres=0.25)
+    assert x[:, 4:].tolist() == [[pytest.approx(.9), 0.], [pytest.approx(.7), 1.]]
+    assert x[0, :4].tolist() == [40., 10., 60., 30.] and x[1, :4].tolist() == [40., 10., 60., 30.]
@@ -0,0 +1,41 @@
+from collections import Counter
+
+import cv2
+import numpy as np
+import pytest
+import torch
+
+from vision_test.utils.datasets import LoadImagesAndLabels, LoadShards, make_shards
+
+
+@pytest.fixture(scope='module')
+def shards(tmp_path_factory):
+    # 12 images in 3 shards of <= 5
+    path = tmp_path_factory.mktemp('data')
+    (path / 'images').mkdir()
+    (path / 'labels').mkdir()
+    for i in range(12):
+        cv2.imwrite(str(path / 'images' / f'{i}.jpg'), np.full((48, 64, 3), 10 * i, np.uint8))
+        (path / 'labels' / f'{i}.txt').write_text(f'{i % 3} 0.5 0.5 0.25 0.25\n')
+    return make_shards(str(path / 'images'), shard_size=5), sorted(str(x) for x in (path / 'images').iterdir())
+
+
+@pytest.mark.parametrize('workers, batch_size', [(0, 4), (4, 4), (5, 2), (2, 5)])
+def test_testing_yields_every_sample_once(shards, workers, batch_size):
+    out, files = shards
+    dataset = LoadShards(out, 64, batch_size=batch_size)
+    assert len(dataset.shards) == 3
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=workers,
+                                         collate_fn=LoadImagesAndLabels.collate_fn)
+    paths, nb = Counter(), 0
+    for imgs, targets, p, _ in loader:
+        paths.update(p)
+        nb += 1
+    assert sorted(paths) == files and set(paths.values()) == {1}
+    assert nb == len(loader)  # whole batches per worker, no extra partial ones
+
+
+def test_testing_ranks_disjoint(shards):
+    out, files = shards
+    paths = [[x[2] for x in LoadShards(out, 64, rank=r, world_size=3, batch_size=2)] for r in range(3)]
+    assert sorted(p for x in paths for p in x) == files
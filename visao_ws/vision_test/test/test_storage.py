@@ -0,0 +1,32 @@
+import numpy as np
+
+from vision_test.utils.datasets import PackedStrings, Ragged, RaggedSegments
+
+
+def test_ragged_indexing():
+    arrays = [np.ones((2, 5)), np.zeros((0, 5)), np.arange(15).reshape(3, 5)]
+    r = Ragged(arrays)
+    assert len(r) == 3
+    assert [len(x) for x in r] == [2, 0, 3]
+    assert np.array_equal(r[2], arrays[2]) and r[2].dtype == np.float32
+    assert np.shares_memory(r[0], r.data)  # items are views
+    t = r.take([2, 1, 0, 2])
+    assert [len(x) for x in t] == [3, 0, 2, 3]
+    assert all(np.array_equal(a, r[i]) for a, i in zip(t, [2, 1, 0, 2]))
+    assert len(Ragged()) == 0 and Ragged().data.shape == (0, 5)
+
+
+def test_ragged_segments_take():
+    segments = [[np.ones((3, 2)), np.zeros((4, 2))], [], [np.full((5, 2), 2.)]]
+    s = RaggedSegments(segments)
+    assert len(s) == 3 and s[1] == []
+    t = s.take([2, 0, 1])
+    assert [len(x) for x in t[0]] == [5] and [len(x) for x in t[1]] == [3, 4] and t[2] == []
+    assert np.array_equal(t[1][1], segments[0][1])
+
+
+def test_packed_strings():
+    strings = ['a/images/0.jpg', '', 'ç/ñ.png']
+    p = PackedStrings(strings)
+    assert len(p) == 3
+    assert list(p) == strings and p[2] == strings[2]
@@ -0,0 +1,124 @@
+import argparse
+import sys
+from argparse import Namespace
+from pathlib import Path
+
+sys.path.append('./')  # to run '$ python *.py' files in subdirectories
+
+import numpy as np
+import torch
+import yaml
+
+import test  # import test.py to get mAP
+from models.experimental import attempt_load
+from models.yolo import Model
+from utils.datasets import create_dataloader, letterbox
+from utils.general import check_dataset, check_img_size, colorstr, increment_path, non_max_suppression, set_logging
+from utils.torch_utils import select_device, time_synchronized
+
+
+def latency(model, imgsz, device, n=50, frame=(1080, 1920)):
+    # End-to-end batch-1 latency in ms (letterbox + forward + NMS) on a synthetic camera frame, (median, p95)
+    im0 = np.random.randint(0, 255, (*frame, 3), dtype=np.uint8)  # BGR frame
+    stride = int(model.stride.max())
+    dt = []
+    for i in range(n + 5):  # 5 warmup iterations
+        t = time_synchronized()
+        img = letterbox(im0, imgsz, stride=stride)[0][:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3xhxw
+        img = torch.from_numpy(np.ascontiguousarray(img)).to(device).float()[None] / 255.0
+        with torch.no_grad():
+            non_max_suppression(model(img)[0], 0.25, 0.45)
+        if i >= 5:
+            dt.append((time_synchronized() - t) * 1E3)
+    return float(np.median(dt)), float(np.percentile(dt, 95))
+
+
+def pareto(rows):
+    # Rows not beaten by any faster row on mAP@.5, sorted by latency
+    front, best = [], -1.
+    for r in sorted(rows, key=lambda x: x['latency_ms']):
+        if r['map50'] > best:
+            front.append(r)
+            best = r['map50']
+    return front
+
+
+def select(front, budget):
+    # Most accurate Pareto point within budget (ms), else the fastest one
+    fit = [r for r in front if r['latency_ms'] <= budget]
+    return fit[-1] if fit else front[0]
+
+
+def run(opt):
+    set_logging()
+    device = select_device(opt.device)
+    save_dir = Path(increment_path(Path(opt.project) / opt.name, exist_ok=opt.exist_ok))  # increment run
+    save_dir.mkdir(parents=True, exist_ok=True)
+    data = None
+    if opt.data:
+        with open(opt.data) as f:
+            data = yaml.load(f, Loader=yaml.SafeLoader)
+        check_dataset(data)
+
+    rows = []
+    for w in opt.weights + opt.cfg:
+        if w.endswith('.pt'):
+            model = attempt_load(w, map_location=device)  # load FP32 model
+        else:  # untrained *.yaml, latency only
+            with torch.no_grad():  # fuse() updates parameters in place
+                model = Model(w, nc=data['nc'] if data else None).to(device).fuse().eval()
+        gs = max(int(model.stride.max()), 32)  # grid size (max stride)
+        for imgsz in sorted({check_img_size(x, gs) for x in opt.img_sizes}):
+            t50, t95 = latency(model, imgsz, device, n=opt.n)
+            map50 = map = float('nan')
+            if data and w.endswith('.pt'):
+                dataloader = create_dataloader(data['val'], imgsz, opt.batch_size, gs, Namespace(single_cls=False),
+                                               pad=0.5, rect=True, prefix=colorstr('val: '))[0]
+                (_, _, map50, map, *_), _, _ = test.test(data, batch_size=opt.batch_size, imgsz=imgsz, model=model,
+                                                         dataloader=dataloader, save_dir=save_dir, plots=False,
+                                                         half_precision=False)
+            rows.append({'weights': w, 'img_size': imgsz, 'latency_ms': round(t50, 2), 'p95_ms': round(t95, 2),
+                         'map50': round(float(map50), 4), 'map': round(float(map), 4)})
+            print(f"{w:>40s}{imgsz:8d}{t50:10.1f}ms{t95:10.1f}ms{map50:10.4f}{map:10.4f}")
+
+    # Pareto table, over trained *.pt weights only (a *.yaml cfg cannot be deployed)
+    trained = [r for r in rows if r['weights'].endswith('.pt')]
+    front = pareto([r for r in trained if not np.isnan(r['map50'])])
+    mode = 'map50' if front else 'latency-only'  # without --data every trained row is a candidate, by latency
+    front = front or sorted(trained, key=lambda x: x['latency_ms'])
+    with open(save_dir / 'results.csv', 'w') as f:
+        f.write('weights,img_size,latency_ms,p95_ms,map50,map,pareto\n')
+        for r in sorted(rows, key=lambda x: x['latency_ms']):
+            f.write(','.join(str(r[k]) for k in ('weights', 'img_size', 'latency_ms', 'p95_ms', 'map50', 'map')) +
+                    f",{r in front}\n")
+
+    # Runtime profile for the detect node: python -m vision_test.detect --runtime-profile profile.yaml
+    if not front:
+        print(f'No trained --weights to select from, latency results saved to {save_dir}')
+        return None
+    best = select(front, opt.budget)
+    profile = {'budget_ms': opt.budget, 'device': str(device), 'weights': best['weights'],
+               'img_size': best['img_size'], 'selection': mode, 'pareto': front}
+    with open(save_dir / 'profile.yaml', 'w') as f:
+        yaml.safe_dump(profile, f, sort_keys=False)
+    print(f"Selected {best['weights']} at {best['img_size']} ({best['latency_ms']}ms, mAP@.5 {best['map50']}, "
+          f"{mode}) for a {opt.budget}ms budget. Results saved to {save_dir}")
+    return profile
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='autoselect.py')
+    parser.add_argument('--weights', nargs='+', type=str, default=[], help='model.pt path(s)')
+    parser.add_argument('--cfg', nargs='+', type=str, default=[], help='model.yaml path(s), latency only')
+    parser.add_argument('--data', type=str, default='', help='*.data path for mAP, empty for latency only')
+    parser.add_argument('--img-sizes', nargs='+', type=int, default=[256, 320, 416, 512, 640], help='sizes to try')
+    parser.add_argument('--budget', type=float, default=30., help='latency budget (ms)')
+    parser.add_argument('--batch-size', type=int, default=16, help='validation batch size')
+    parser.add_argument('--n', type=int, default=50, help='timed iterations per point')
+    parser.add_argument('--device', default='cpu', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
+    parser.add_argument('--project', default='runs/select', help='save to project/name')
+    parser.add_argument('--name', default='exp', help='save to project/name')
+    parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
+    opt = parser.parse_args()
+    print(opt)
+    run(opt)
@@ -1,9 +1,10 @@
 # import the necessary packages
 from threading import Thread
+import os
 import cv2
 
 class WebcamVideoStream:
-	def __init__(self, src=0):
+	def __init__(self, src=0, cores=None):
 		# initialize the video camera stream and read the first frame
 		# from the stream
 		self.stream = cv2.VideoCapture(src)
@@ -14,6 +15,7 @@ class WebcamVideoStream:
 		# initialize the variable used to indicate if the thread should
 		# be stopped
 		self.stopped = False
+		self.cores = cores  # cores the capture thread is pinned to, None to inherit
 
 	def start(self):
 		# start the thread to read frames from the video stream
@@ -23,6 +25,10 @@ class WebcamVideoStream:
 		return self
 
 	def update(self):
+		# keep the capture thread off the inference cores
+		if self.cores and hasattr(os, 'sched_setaffinity'):
+			os.sched_setaffinity(0, self.cores)
+
 		# keep looping infinitely until the thread is stopped
 		while True:
 			# if the thread indicator variable is set, stop the thread
@@ -21,6 +21,7 @@ import cv2
 import ctypes
 from math import log,exp,tan,radians
 from .camvideostream import WebcamVideoStream
+from .ClassConfig import classConfig
 #import imutils
 
 from .serialization import *
@@ -40,15 +41,17 @@ from pathlib import Path
 import cv2
 import torch
 import torch.backends.cudnn as cudnn
+import yaml
 from numpy import random
 
 
 from .experimental import attempt_load
-from .utils.datasets import LoadStreams, LoadImages
+from .utils.datasets import LoadStreams, LoadImages, tile_image, letterbox
 from .utils.general import check_img_size, check_requirements, check_imshow, non_max_suppression, apply_classifier, \
-    scale_coords, xyxy2xywh, strip_optimizer, set_logging, increment_path
+    scale_coords, xyxy2xywh, strip_optimizer, set_logging, increment_path, non_max_suppression_batched, merge_tiles, \
+    NMS_ENGINES, NMS_DEFAULT
 from .utils.plots import plot_one_box
-from .utils.torch_utils import select_device, load_classifier, time_synchronized, TracedModel
+from .utils.torch_utils import select_device, load_classifier, time_synchronized, TracedModel, set_threads, CompiledModel
 
 PATH_TO_WEIGHTS = '/home/robofei/Desktop/visao_ws/vision_test/vision_test/best.pt'
 
@@ -71,7 +74,35 @@ parser.add_argument('--project', default='runs/detect', help='save results to pr
 parser.add_argument('--name', default='exp', help='save results to project/name')
 parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
 parser.add_argument('--no-trace', action='store_true', help='don`t trace model')
+parser.add_argument('--fused-decode', action='store_true', help='decode all head levels at once with cached grids')
+parser.add_argument('--batched-nms', action='store_true', help='run NMS for the whole batch at once')
+parser.add_argument('--nms-engine', default=NMS_DEFAULT, choices=list(NMS_ENGINES), help='NMS implementation')
+parser.add_argument('--tile', type=int, default=0, help='sliced inference tile size (pixels), 0 to disable')
+parser.add_argument('--tile-overlap', type=float, default=0.2, help='overlap between neighbouring tiles')
+parser.add_argument('--tile-global', action='store_true', help='add a low-res full-frame pass to sliced inference')
+parser.add_argument('--tile-far', action='store_true', help='tile only the far field above ClassConfig.y_longe, implies --tile-global')
+parser.add_argument('--gated-decode', action='store_true', help='decode only cells with objectness above --conf-thres')
+parser.add_argument('--concat-plan', default='', help='inference Concat plan: buffer or split (see Model.plan_concat)')
+parser.add_argument('--compile', default='', help='compile the fused model: jit (frozen TorchScript) or inductor')
+parser.add_argument('--compile-cache', default='runs/compiled', help='compiled graph cache directory')
+parser.add_argument('--cascade-weights', type=str, default='', help='large model run only on uncertain frames')
+parser.add_argument('--cascade-band', nargs=2, type=float, default=[0.25, 0.6], help='tiny best-conf band sent to the large model')
+parser.add_argument('--cascade-lost', type=int, default=10, help='frames without a confident ball before a large full-frame pass')
+parser.add_argument('--cascade-roi', type=int, default=0, help='large model on a square ROI this size around the proposal, 0 for full frame')
+parser.add_argument('--threads-profile', type=str, default='', help='tune_threads.py threads.yaml, applied at startup')
+parser.add_argument('--runtime-profile', type=str, default='', help='autoselect.py profile.yaml, sets weights and img-size')
 opt = parser.parse_args()
+opt.tile_global |= opt.tile_far  # the near field below y_longe is only covered by the full-frame pass
+if opt.runtime_profile:  # latency-budgeted weights/img-size picked by autoselect.py
+    with open(opt.runtime_profile) as f:
+        profile = yaml.load(f, Loader=yaml.SafeLoader)
+    opt.weights, opt.img_size = profile['weights'], profile['img_size']
+threads = {}
+if opt.threads_profile:  # thread counts and core affinity picked by tune_threads.py
+    with open(opt.threads_profile) as f:
+        threads = yaml.load(f, Loader=yaml.SafeLoader)
+    set_threads(threads['threads'], threads['interop_threads'], threads['cores'])
+    cv2.setNumThreads(threads['cv2_threads'])
 print(opt)
 
 
@@ -80,12 +111,23 @@ class ballStatus(Node):
     def __init__(self):
         super().__init__('detect')
         self.publisher_ = self.create_publisher(Vision, '/ball_position', 10)
-        self.vcap = WebcamVideoStream(src=0).start() # Abrindo camera
+        self.vcap = WebcamVideoStream(src=0, cores=threads.get('capture_cores')).start() # Abrindo camera
         timer_period = 0.008  # seconds
         self.timer = self.create_timer(timer_period, self.thread_DNN)
         self.i = 0
         self.weights = PATH_TO_WEIGHTS
         self.update = True
+        self.missed = 0  # consecutive frames without a confident ball
+        self.cascade_stats = {'frames': 0, 'band': 0, 'lost': 0, 'roi': 0, 'tiny_ms': 0., 'large_ms': 0.}
+        self.compiled = None  # built once, so weights are hashed and graphs loaded once instead of every frame
+        self.model_l = None  # large cascade model, loaded once instead of every frame
+        device = select_device(opt.device)
+        if opt.cascade_weights:  # second stage of the cascade
+            self.model_l = attempt_load(opt.cascade_weights, map_location=device)
+            self.model_l.model[-1].fused_decode = opt.fused_decode
+        if opt.compile:
+            model = self.load_model(opt.weights, device)
+            self.compiled = CompiledModel(model, opt.compile, cache_dir=opt.compile_cache)  # graphs cached on disk
 
     def thread_DNN(self):
         msg=Vision()
@@ -115,6 +157,15 @@ class ballStatus(Node):
                 self.detect(frame)
 
 
+    def load_model(self, weights, device):
+        # FP32 fused model with the head options from opt
+        model = attempt_load(weights, map_location=device)  # load FP32 model
+        model.model[-1].fused_decode = opt.fused_decode  # single fused decode of all detection levels
+        model.model[-1].gate_conf = opt.conf_thres if opt.gated_decode else None  # sparse objectness-gated decode
+        if opt.concat_plan:
+            model.plan_concat(opt.concat_plan)  # persistent Concat buffers or split-weight 1x1 convs
+        return model
+
     def detect(self, frame):
         source, weights, view_img, save_txt, imgsz, trace = opt.source, opt.weights, opt.view_img, opt.save_txt, opt.img_size, not opt.no_trace
         
@@ -131,11 +182,13 @@ class ballStatus(Node):
         half = False
 
      # Load model
-        model = attempt_load(weights, map_location=device)  # load FP32 model
+        model = self.compiled if self.compiled is not None else self.load_model(weights, device)
         stride = int(model.stride.max())  # model stride
         imgsz = check_img_size(imgsz, s=stride)  # check img_size
 
-        if trace:
+        model_l = self.model_l  # second stage of the cascade, None without --cascade-weights
+
+        if trace and not opt.compile:
             model = TracedModel(model, device, opt.img_size)
 
         if half:
@@ -184,11 +237,34 @@ class ballStatus(Node):
 
             # Inference
             t1 = time_synchronized()
-            pred = model(img, augment=opt.augment)[0]
+            tiled = opt.tile > 0
+            pred = model(img, augment=opt.augment)[0] if not tiled or opt.tile_global else None
             t2 = time_synchronized()
 
             # Apply NMS
-            pred = non_max_suppression(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms)
+            nms = non_max_suppression_batched if opt.batched_nms else non_max_suppression
+            if pred is not None:
+                pred = nms(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms,
+                           engine=opt.nms_engine)
+
+            # Sliced inference on the original frames, detections in original pixels
+            if tiled:
+                frames = im0s if webcam else [im0s]
+                if pred is not None:  # low-res global pass
+                    for det, im0 in zip(pred, frames):
+                        det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape)
+                pred = [self.detect_tiled(model, im0, device, half, nms, None if pred is None else pred[i])
+                        for i, im0 in enumerate(frames)]
+
+            # Cascade, detections in original pixels
+            cascade = model_l is not None
+            if cascade:
+                frames = im0s if webcam else [im0s]
+                for det, im0 in zip(pred, frames):
+                    if not tiled:
+                        det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape)
+                pred = [self.cascade(model_l, im0, pred[i], device, half, nms, 1E3 * (t2 - t1))
+                        for i, im0 in enumerate(frames)]
             t3 = time_synchronized()
 
             # Apply Classifier
@@ -208,7 +284,9 @@ class ballStatus(Node):
                 gn = torch.tensor(im0.shape)[[1, 0, 1, 0]]  # normalization gain whwh
                 if len(det):
                     # Rescale boxes from img_size to im0 size
-                    det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape).round()
+                    if not tiled and not cascade:
+                        det[:, :4] = scale_coords(img.shape[2:], det[:, :4], im0.shape)
+                    det[:, :4] = det[:, :4].round()
 
                     # Print results
                     for c in det[:, -1].unique():
@@ -229,6 +307,11 @@ class ballStatus(Node):
 
                 # Print time (inference + NMS)
                 print(f'{s}Done. ({(1E3 * (t2 - t1)):.1f}ms) Inference, ({(1E3 * (t3 - t2)):.1f}ms) NMS')
+                if cascade:
+                    c = self.cascade_stats
+                    n, nl = c['frames'], c['band'] + c['lost']
+                    print(f"Cascade: large model on {nl}/{n} frames ({c['band']} band, {c['lost']} lost, {c['roi']} ROI), "
+                          f"tiny {c['tiny_ms'] / max(n, 1):.1f}ms, large {c['large_ms'] / max(nl, 1):.1f}ms mean")
 
                 # Stream results
                 if view_img:
@@ -262,6 +345,63 @@ class ballStatus(Node):
         print(f'Done. ({time.time() - t0:.3f}s)')
 
 
+    def detect_tiled(self, model, im0, device, half, nms, extra=None):
+        # Run overlapping tiles of im0 as one batch and merge their detections with cross-tile NMS
+        if opt.tile_far and not hasattr(self, 'config'):
+            self.config = classConfig()
+        y_max = self.config.y_longe if opt.tile_far else None  # far balls appear above y_longe
+        tiles, offsets = tile_image(im0, opt.tile, opt.tile_overlap, stride=int(model.stride.max()), y_max=y_max)
+        img = torch.from_numpy(tiles).to(device)
+        img = img.half() if half else img.float()  # uint8 to fp16/32
+        img /= 255.0  # 0 - 255 to 0.0 - 1.0
+        pred = model(img, augment=opt.augment)[0]
+        pred = nms(pred, opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms,
+                   engine=opt.nms_engine)
+        return merge_tiles(pred, offsets, opt.iou_thres, agnostic=opt.agnostic_nms, extra=extra, engine=opt.nms_engine,
+                           conf_thres=opt.conf_thres)
+
+    def cascade(self, model_l, im0, det, device, half, nms, tiny_ms):
+        # Second stage: large model when the best tiny confidence is in the uncertainty band or the ball is lost
+        c = self.cascade_stats
+        c['frames'] += 1
+        c['tiny_ms'] += tiny_ms
+        lo, hi = opt.cascade_band
+        best = det[:, 4].max().item() if len(det) else 0.
+        band = lo <= best < hi
+        lost = best < lo and (self.missed + 1) % opt.cascade_lost == 0  # retry every cascade_lost missed frames
+        if band or lost:
+            t = time_synchronized()
+            x0 = y0 = 0
+            crop = im0
+            if band and opt.cascade_roi:  # ROI around the tiny proposal
+                b = det[det[:, 4].argmax(), :4].tolist()
+                r = max(opt.cascade_roi, int(max(b[2] - b[0], b[3] - b[1]) * 2))  # side
+                x0 = int(min(max((b[0] + b[2] - r) / 2, 0), max(im0.shape[1] - r, 0)))
+                y0 = int(min(max((b[1] + b[3] - r) / 2, 0), max(im0.shape[0] - r, 0)))
+                crop = im0[y0:y0 + r, x0:x0 + r]
+                c['roi'] += 1
+            stride = int(model_l.stride.max())
+            img = letterbox(crop, check_img_size(min(opt.img_size, max(crop.shape[:2])), s=stride), stride=stride)[0]
+            img = torch.from_numpy(np.ascontiguousarray(img[:, :, ::-1].transpose(2, 0, 1))).to(device)  # BGR to RGB
+            img = (img.half() if half else img.float())[None] / 255.0
+            d = nms(model_l(img)[0], opt.conf_thres, opt.iou_thres, classes=opt.classes, agnostic=opt.agnostic_nms,
+                    engine=opt.nms_engine)[0]
+            d[:, :4] = scale_coords(img.shape[2:], d[:, :4], crop.shape)
+            d[:, [0, 2]] += x0
+            d[:, [1, 3]] += y0
+            if crop is im0:
+                det = d
+            else:  # large-model detections replace the tiny ones inside the ROI
+                cx, cy = (det[:, 0] + det[:, 2]) / 2, (det[:, 1] + det[:, 3]) / 2
+                inside = (cx >= x0) & (cx < x0 + crop.shape[1]) & (cy >= y0) & (cy < y0 + crop.shape[0])
+                det = torch.cat((det[~inside], d), 0)
+            c['band' if band else 'lost'] += 1
+            c['large_ms'] += 1E3 * (time_synchronized() - t)
+            best = det[:, 4].max().item() if len(det) else 0.
+        self.missed = 0 if best >= hi else self.missed + 1
+        return det
+
+
 def main(args=None):
     rclpy.init(args=args)
     
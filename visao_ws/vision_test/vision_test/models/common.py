@@ -61,6 +61,18 @@ class Concat(nn.Module):
     def forward(self, x):
         return torch.cat(x, self.d)
 
+    def bufferforward(self, x):
+        # Inference-only: concatenate into a persistent buffer instead of allocating a new tensor every call
+        shape = list(x[0].shape)
+        shape[self.d] = sum(xi.shape[self.d] for xi in x)
+        b = getattr(self, 'buf', None)
+        if b is None or list(b.shape) != shape or b.device != x[0].device or b.dtype != x[0].dtype:
+            b = self.buf = torch.empty(shape, device=x[0].device, dtype=x[0].dtype)
+        return torch.cat(x, self.d, out=b)
+
+    def splitforward(self, x):
+        return x  # inputs are consumed unconcatenated by the next Conv.splitforward()
+
 
 class Chuncat(nn.Module):
     def __init__(self, dimension=1):
@@ -109,6 +121,14 @@ class Conv(nn.Module):
 
     def fuseforward(self, x):
         return self.act(self.conv(x))
+
+    def splitforward(self, x):
+        # Fused 1x1 conv of a list of inputs as a sum of per-input convs over weight slices, cat(x) never built
+        w = self.conv.weight.split([xi.shape[1] for xi in x], 1)
+        y = F.conv2d(x[0], w[0], self.conv.bias)
+        for xi, wi in zip(x[1:], w[1:]):
+            y += F.conv2d(xi, wi)
+        return self.act(y)
     
 
 class RobustConv(nn.Module):
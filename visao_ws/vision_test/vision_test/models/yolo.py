@@ -1,7 +1,11 @@
 import argparse
+import json
 import logging
+import re
 import sys
+from collections import OrderedDict
 from copy import deepcopy
+from pathlib import Path
 
 sys.path.append('./')  # to run '$ python *.py' files in subdirectories
 logger = logging.getLogger(__name__)
@@ -20,12 +24,100 @@ except ImportError:
     thop = None
 
 
+class DecodeCache:
+    # LRU of concatenated decode grids for a detection head, keyed by the feature shapes of all levels
+    def __init__(self, maxsize=4):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+
+    def get(self, head, x):
+        key = (tuple(tuple(xi.shape[2:]) for xi in x), x[0].device, x[0].dtype)
+        e = self.entries.get(key)
+        if e is None:
+            e = self.entries[key] = self.build(head, x)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)  # drop least recently used shape
+        else:
+            self.entries.move_to_end(key)
+        return e
+
+    @staticmethod
+    def build(head, x):
+        offset, gain, anchor = [], [], []
+        for i, xi in enumerate(x):
+            ny, nx = xi.shape[2:]
+            s = head.stride[i].item()
+            g = head._make_grid(nx, ny).to(xi.device).expand(1, head.na, ny, nx, 2).reshape(1, -1, 2)
+            a = head.anchor_grid[i].to(xi.device).expand(1, head.na, ny, nx, 2).reshape(1, -1, 2)
+            offset.append((g - 0.5) * s)  # xy = sig * 2s + (grid - 0.5) * s
+            gain.append(torch.full((1, g.shape[1], 1), 2. * s, device=xi.device))
+            anchor.append(a * 4.)  # wh = sig ** 2 * 4 * anchor
+        dtype = x[0].dtype
+        return {'offset': torch.cat(offset, 1).to(dtype), 'gain': torch.cat(gain, 1).to(dtype),
+                'anchor': torch.cat(anchor, 1).to(dtype), 'out': None}
+
+
+def decode_fused(head, x):
+    # Decode raw conv outputs x[i](bs,na*no,ny,nx) of all levels into one preallocated (bs,n,no) buffer.
+    # The buffer is reused for the next input of the same shape, so callers must consume it before then.
+    if getattr(head, 'decode_cache', None) is None:
+        head.decode_cache = DecodeCache(head.grid_cache_size)
+    e = head.decode_cache.get(head, x)
+    if head.gate_conf is not None:
+        return decode_gated(head, x, e)
+    bs = x[0].shape[0]
+    if e['out'] is None or e['out'].shape[0] != bs:
+        e['out'] = torch.empty(bs, e['offset'].shape[1], head.no, device=x[0].device, dtype=x[0].dtype)
+    out, j, raw = e['out'], 0, []
+    for xi in x:
+        _, _, ny, nx = xi.shape
+        k = head.na * ny * nx
+        xi = xi.view(bs, head.na, head.no, ny, nx).permute(0, 1, 3, 4, 2)  # x(bs,3,20,20,85) view, no copy
+        out[:, j:j + k].view(bs, head.na, ny, nx, head.no).copy_(xi)
+        raw.append(xi)
+        j += k
+    out.sigmoid_()
+    out[..., 0:2].mul_(e['gain']).add_(e['offset'])  # xy
+    out[..., 2:4].pow_(2).mul_(e['anchor'])  # wh
+    return out, raw
+
+
+def decode_gated(head, x, e):
+    # Decode only cells whose raw objectness logit exceeds logit(gate_conf), i.e. sigmoid(obj) > gate_conf.
+    # Returns (bs,n,no) with n the largest per-image candidate count, zero-padded (obj=0) for other images.
+    c = head.gate_conf
+    t = math.log(c / (1 - c)) if 0 < c < 1 else (-math.inf if c <= 0 else math.inf)  # inverse sigmoid
+    bs, j, raw, b, idx, v = x[0].shape[0], 0, [], [], [], []
+    for xi in x:
+        _, _, ny, nx = xi.shape
+        xi = xi.view(bs, head.na, head.no, ny, nx)
+        bi, ai, yi, xj = (xi[:, :, 4] > t).nonzero(as_tuple=True)  # surviving cells
+        b.append(bi)
+        idx.append(j + (ai * ny + yi) * nx + xj)  # index into the concatenated grid
+        v.append(xi[bi, ai, :, yi, xj])  # (k,no)
+        raw.append(xi.permute(0, 1, 3, 4, 2))
+        j += head.na * ny * nx
+    b, idx, v = torch.cat(b), torch.cat(idx), torch.cat(v).sigmoid()
+    v[:, 0:2] = v[:, 0:2] * e['gain'][0, idx] + e['offset'][0, idx]  # xy
+    v[:, 2:4] = v[:, 2:4] ** 2 * e['anchor'][0, idx]  # wh
+
+    n = torch.bincount(b, minlength=bs)
+    b, order = b.sort(stable=True)
+    pos = torch.arange(len(b), device=b.device) - (n.cumsum(0) - n)[b]  # slot within each image
+    out = torch.zeros(bs, int(n.max()) if len(b) else 0, head.no, device=v.device, dtype=v.dtype)
+    out[b, pos] = v[order]
+    return out, raw
+
+
 class Detect(nn.Module):
     stride = None  # strides computed during build
     export = False  # onnx export
     end2end = False
     include_nms = False
     concat = False
+    fused_decode = False  # decode all levels at once using grids cached per input shape
+    grid_cache_size = 4  # number of input shapes kept in the decode cache
+    gate_conf = None  # decode only cells with objectness above this threshold (sparse, implies fused_decode)
 
     def __init__(self, nc=80, anchors=(), ch=()):  # detection layer
         super(Detect, self).__init__()
@@ -43,6 +135,12 @@ class Detect(nn.Module):
         # x = x.copy()  # for profiling
         z = []  # inference output
         self.training |= self.export
+        if (self.fused_decode or self.gate_conf is not None) and not self.training and \
+                not torch.onnx.is_in_onnx_export():
+            z, x = decode_fused(self, [self.m[i](x[i]) for i in range(self.nl)])
+            if self.end2end or self.concat:
+                return z
+            return (self.convert([z]), ) if self.include_nms else (z, x)
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
@@ -100,6 +198,9 @@ class IDetect(nn.Module):
     end2end = False
     include_nms = False
     concat = False
+    fused_decode = False  # decode all levels at once using grids cached per input shape
+    grid_cache_size = 4  # number of input shapes kept in the decode cache
+    gate_conf = None  # decode only cells with objectness above this threshold (sparse, implies fused_decode)
 
     def __init__(self, nc=80, anchors=(), ch=()):  # detection layer
         super(IDetect, self).__init__()
@@ -120,6 +221,9 @@ class IDetect(nn.Module):
         # x = x.copy()  # for profiling
         z = []  # inference output
         self.training |= self.export
+        if (self.fused_decode or self.gate_conf is not None) and not self.training and \
+                not torch.onnx.is_in_onnx_export():
+            return decode_fused(self, [self.im[i](self.m[i](self.ia[i](x[i]))) for i in range(self.nl)])
         for i in range(self.nl):
             x[i] = self.m[i](self.ia[i](x[i]))  # conv
             x[i] = self.im[i](x[i])
@@ -141,6 +245,12 @@ class IDetect(nn.Module):
         # x = x.copy()  # for profiling
         z = []  # inference output
         self.training |= self.export
+        if (self.fused_decode or self.gate_conf is not None) and not self.training and \
+                not torch.onnx.is_in_onnx_export():
+            z, x = decode_fused(self, [self.m[i](x[i]) for i in range(self.nl)])
+            if self.end2end or self.concat:
+                return z
+            return (self.convert([z]), ) if self.include_nms else (z, x)
         for i in range(self.nl):
             x[i] = self.m[i](x[i])  # conv
             bs, _, ny, nx = x[i].shape  # x(bs,255,20,20) to x(bs,3,20,20,85)
@@ -506,6 +616,8 @@ class IBin(nn.Module):
 
 
 class Model(nn.Module):
+    batch_augment = True  # run the augmented inference scales and flips as one padded batch
+
     def __init__(self, cfg='yolor-csp-c.yaml', ch=3, nc=None, anchors=None):  # model, input channels, number of classes
         super(Model, self).__init__()
         self.traced = False
@@ -579,6 +691,8 @@ class Model(nn.Module):
         logger.info('')
 
     def forward(self, x, augment=False, profile=False):
+        if augment and self.batch_augment:
+            return self.forward_augment(x)  # augmented inference in a single pass
         if augment:
             img_size = x.shape[-2:]  # height, width
             s = [1, 0.83, 0.67]  # scales
@@ -598,7 +712,30 @@ class Model(nn.Module):
         else:
             return self.forward_once(x, profile)  # single-scale inference, train
 
+    def forward_augment(self, x):
+        img_size = x.shape[-2:]  # height, width
+        s = [1, 0.83, 0.67]  # scales
+        f = [None, 3, None]  # flips (2-ud, 3-lr)
+        gs = int(self.stride.max())
+        h, w = [math.ceil(v / gs) * gs for v in img_size]  # padded size, the largest scale
+        xi = [scale_img(x.flip(fi) if fi else x, si, gs=gs) for si, fi in zip(s, f)]
+        xi = torch.cat([F.pad(v, [0, w - v.shape[3], 0, h - v.shape[2]], value=0.447) for v in xi], 0)
+        y = self.forward_once(xi)[0]
+        y = y.view(len(s), x.shape[0], -1, y.shape[-1])  # (scales,bs,n,no)
+
+        # Drop padding, de-scale and de-flip all scales at once
+        wh = torch.tensor([[int(img_size[1] * si), int(img_size[0] * si)] for si in s], device=y.device)
+        y[..., 4] *= (y[..., :2] < wh.view(-1, 1, 1, 2)).all(-1)  # no detections centred on padding
+        y[..., :4] /= torch.tensor(s, device=y.device, dtype=y.dtype).view(-1, 1, 1, 1)  # de-scale
+        lr = torch.tensor([fi == 3 for fi in f], device=y.device).view(-1, 1, 1)
+        ud = torch.tensor([fi == 2 for fi in f], device=y.device).view(-1, 1, 1)
+        y[..., 0] = torch.where(lr, img_size[1] - y[..., 0], y[..., 0])  # de-flip lr
+        y[..., 1] = torch.where(ud, img_size[0] - y[..., 1], y[..., 1])  # de-flip ud
+        return y.transpose(0, 1).reshape(x.shape[0], -1, y.shape[-1]), None  # augmented inference, train
+
     def forward_once(self, x, profile=False):
+        if not hasattr(self.model[-1], 'free'):  # models pickled before liveness was tracked
+            set_liveness(self.model)
         y, dt = [], []  # outputs
         for m in self.model:
             if m.f != -1:  # if not from previous layer
@@ -625,11 +762,50 @@ class Model(nn.Module):
             x = m(x)  # run
             
             y.append(x if m.i in self.save else None)  # save output
+            for j in m.free:
+                y[j] = None  # release saved outputs this layer was the last to read
 
         if profile:
             print('%.1fms total' % sum(dt))
         return x
 
+    def profile_layers(self, x, n=20, warmup=3):
+        # Per-layer table: params, GFLOPS, mean/p95 latency, output shape and bytes, share of total latency.
+        # alloc_bytes (peak CUDA memory allocated by the layer) is CUDA-only, CPU tables have no such column
+        cuda = x.device.type == 'cuda'
+        rows, y = [], []
+        with torch.no_grad():
+            for m in self.model:
+                if m.f != -1:  # if not from previous layer
+                    x = y[m.f] if isinstance(m.f, int) else [x if j == -1 else y[j] for j in m.f]  # from earlier layers
+                c = isinstance(m, (Detect, IDetect, IAuxDetect, IBin, IKeypoint))  # heads modify their inputs in place
+                flops = thop.profile(deepcopy(m), inputs=(x.copy() if c else x,), verbose=False)[0] / 1E9 * 2 \
+                    if thop else float('nan')  # GFLOPS
+                for _ in range(warmup):
+                    m(x.copy() if c else x)
+                if cuda:
+                    torch.cuda.reset_peak_memory_stats()
+                    m0 = torch.cuda.memory_allocated()
+                dt = []
+                for _ in range(n):
+                    t = time_synchronized()
+                    out = m(x.copy() if c else x)
+                    dt.append((time_synchronized() - t) * 1E3)
+                tensors = [v for v in (out if isinstance(out, (list, tuple)) else [out]) if isinstance(v, torch.Tensor)]
+                dt = torch.tensor(dt)
+                rows.append({'i': m.i, 'from': m.f, 'type': m.type, 'params': m.np, 'gflops': round(flops, 4),
+                             'mean_ms': round(dt.mean().item(), 4), 'p95_ms': round(dt.quantile(0.95).item(), 4),
+                             'shape': [list(v.shape) for v in tensors] if len(tensors) > 1 else list(tensors[0].shape),
+                             'bytes': sum(v.numel() * v.element_size() for v in tensors)})
+                if cuda:
+                    rows[-1]['alloc_bytes'] = torch.cuda.max_memory_allocated() - m0
+                x = out
+                y.append(x if m.i in self.save else None)  # save output
+        total = sum(r['mean_ms'] for r in rows)
+        for r in rows:
+            r['share'] = round(r['mean_ms'] / total, 4) if total else 0.
+        return rows
+
     def _initialize_biases(self, cf=None):  # initialize biases into Detect(), cf is class frequency
         # https://arxiv.org/abs/1708.02002 section 3.3
         # cf = torch.bincount(torch.tensor(np.concatenate(dataset.labels, 0)[:, 0]).long(), minlength=nc) + 1.
@@ -709,6 +885,21 @@ class Model(nn.Module):
         self.info()
         return self
 
+    def plan_concat(self, mode='buffer'):  # inference Concat plan: 'buffer', 'split' or None (plain torch.cat)
+        # 'buffer' reuses a persistent output tensor per Concat, 'split' folds a Concat into the fused 1x1 Conv after it
+        for m, n in zip(self.model, list(self.model)[1:] + [None]):
+            if type(m) is not Concat:
+                continue
+            m.__dict__.pop('forward', None)  # back to plain torch.cat
+            if type(n) is Conv and n.forward.__func__ is Conv.splitforward:
+                n.forward = n.fuseforward
+            if mode == 'buffer':
+                m.forward = m.bufferforward
+            elif mode == 'split' and m.d == 1 and m.i not in self.save and type(n) is Conv and n.f == -1 and \
+                    not hasattr(n, 'bn') and n.conv.kernel_size == (1, 1) and n.conv.stride == (1, 1) and n.conv.groups == 1:
+                m.forward, n.forward = m.splitforward, n.splitforward
+        return self
+
     def nms(self, mode=True):  # add or remove NMS module
         present = type(self.model[-1]) is NMS  # last layer is NMS
         if mode and not present:
@@ -810,7 +1001,80 @@ def parse_model(d, ch):  # model_dict, input_channels(3)
         if i == 0:
             ch = []
         ch.append(c2)
-    return nn.Sequential(*layers), sorted(save)
+    layers = nn.Sequential(*layers)
+    set_liveness(layers)
+    return layers, sorted(save)
+
+
+def set_liveness(layers):
+    # Attach to each layer the saved outputs it is the last to read, so forward_once can drop them right after it
+    last = {}  # saved layer index: index of its last consumer
+    for m in layers:
+        for j in ([m.f] if isinstance(m.f, int) else m.f):
+            if j != -1:
+                last[j % m.i] = m.i
+    for m in layers:
+        m.free = [j for j, i in last.items() if i == m.i]
+
+
+def save_profile(rows, file):
+    # Save a Model.profile_layers() table to *.json or *.csv
+    file = Path(file)
+    if file.suffix == '.json':
+        with open(file, 'w') as f:
+            json.dump(rows, f, indent=1)
+    else:
+        keys = list(rows[0].keys())
+        with open(file, 'w') as f:
+            f.write(','.join(keys) + '\n')
+            for r in rows:
+                f.write(','.join('"%s"' % (r[k],) if isinstance(r[k], list) else str(r[k]) for k in keys) + '\n')
+
+
+def load_profile(file):
+    # Load a table written by save_profile()
+    file = Path(file)
+    if file.suffix == '.json':
+        with open(file) as f:
+            return json.load(f)
+    with open(file) as f:
+        keys = f.readline().strip().split(',')
+        return [dict(zip(keys, [v.strip('"') for v in re.findall(r'"[^"]*"|[^,]+', line.strip())])) for line in f]
+
+
+def diff_profiles(a, b):
+    # Compare two profile_layers() tables: layer by layer when both models share a layer sequence, else per module type.
+    # delta_alloc_bytes only when both tables come from CUDA (see Model.profile_layers)
+    ms = lambda r: float(r['mean_ms'])
+    cuda = all('alloc_bytes' in r for r in a + b)
+    t = lambda r: r['type'].split('.')[-1]  # 'models.yolo.Detect' and 'Detect' (run as __main__) are the same
+    if [t(r) for r in a] == [t(r) for r in b]:
+        rows = [{'i': ra['i'], 'type': t(ra), 'a_ms': ms(ra), 'b_ms': ms(rb)} for ra, rb in zip(a, b)]
+        if cuda:
+            for r, ra, rb in zip(rows, a, b):
+                r['delta_alloc_bytes'] = int(rb['alloc_bytes']) - int(ra['alloc_bytes'])
+    else:
+        types = list(dict.fromkeys([t(r) for r in a + b]))
+        rows = [{'type': k, 'a_ms': sum(ms(r) for r in a if t(r) == k),
+                 'b_ms': sum(ms(r) for r in b if t(r) == k)} for k in types]
+        if cuda:
+            for r in rows:
+                r['delta_alloc_bytes'] = sum(int(x['alloc_bytes']) for x in b if t(x) == r['type']) - \
+                                         sum(int(x['alloc_bytes']) for x in a if t(x) == r['type'])
+    for r in rows:
+        r['a_ms'], r['b_ms'] = round(r['a_ms'], 4), round(r['b_ms'], 4)
+        r['delta_ms'] = round(r['b_ms'] - r['a_ms'], 4)
+    return sorted(rows, key=lambda r: -abs(r['delta_ms']))
+
+
+def print_profile(rows):
+    cuda = 'alloc_bytes' in rows[0]  # CUDA profiles only
+    print(f"{'i':>4s}{'type':>40s}{'params':>10s}{'GFLOPS':>10s}{'mean (ms)':>11s}{'p95 (ms)':>10s}{'share':>8s}" +
+          (f"{'alloc (MB)':>12s}" if cuda else '') + '  shape')
+    for r in rows:
+        print(f"{r['i']:>4}{r['type']:>40s}{r['params']:10.0f}{r['gflops']:10.2f}{r['mean_ms']:11.2f}{r['p95_ms']:10.2f}"
+              f"{r['share']:8.1%}" + (f"{r['alloc_bytes'] / 1E6:12.2f}" if cuda else '') + f"  {r['shape']}")
+    print(f"{sum(r['mean_ms'] for r in rows):.1f}ms total")
 
 
 if __name__ == '__main__':
@@ -818,6 +1082,11 @@ if __name__ == '__main__':
     parser.add_argument('--cfg', type=str, default='yolor-csp-c.yaml', help='model.yaml')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--profile', action='store_true', help='profile model speed')
+    parser.add_argument('--weights', type=str, default='', help='model.pt to profile instead of --cfg')
+    parser.add_argument('--img-size', type=int, default=640, help='profiling image size (pixels)')
+    parser.add_argument('--profile-out', type=str, default='', help='save the per-layer profile to *.json or *.csv')
+    parser.add_argument('--plan-concat', action='store_true', help='validate and benchmark Model.plan_concat() modes')
+    parser.add_argument('--diff', type=str, default='', help='profile *.json/*.csv, *.yaml or *.pt to compare against')
     opt = parser.parse_args()
     opt.cfg = check_file(opt.cfg)  # check file
     set_logging()
@@ -828,8 +1097,41 @@ if __name__ == '__main__':
     model.train()
     
     if opt.profile:
-        img = torch.rand(1, 3, 640, 640).to(device)
-        y = model(img, profile=True)
+        img = torch.rand(1, 3, opt.img_size, opt.img_size).to(device)
+        if opt.weights:
+            model = attempt_load(opt.weights, map_location=device)
+        rows = model.eval().profile_layers(img)
+        print_profile(rows)
+        if opt.profile_out:
+            save_profile(rows, opt.profile_out)
+        if opt.diff:
+            if opt.diff.endswith(('.json', '.csv')):
+                other = load_profile(opt.diff)
+            else:
+                other = (attempt_load(opt.diff, map_location=device) if opt.diff.endswith('.pt') else
+                         Model(check_file(opt.diff)).to(device)).eval().profile_layers(img)
+            diff = diff_profiles(rows, other)
+            cuda = 'delta_alloc_bytes' in diff[0]
+            print(f"\n{'i':>4s}{'type':>40s}{'a (ms)':>10s}{'b (ms)':>10s}{'delta':>10s}" +
+                  (f"{'alloc (MB)':>12s}" if cuda else ''))
+            for r in diff:
+                print(f"{r.get('i', ''):>4}{r['type']:>40s}{r['a_ms']:10.2f}{r['b_ms']:10.2f}{r['delta_ms']:+10.2f}" +
+                      (f"{r['delta_alloc_bytes'] / 1E6:+12.2f}" if cuda else ''))
+
+    if opt.plan_concat:
+        img = torch.rand(1, 3, opt.img_size, opt.img_size).to(device)
+        model = (attempt_load(opt.weights, map_location=device) if opt.weights else model.fuse()).eval()
+        with torch.no_grad():
+            y0 = model(img)[0]
+            for mode in [None, 'buffer', 'split']:
+                model.plan_concat(mode)
+                y = model(img)[0]  # warmup, allocates buffers
+                t = time_synchronized()
+                for _ in range(20):
+                    model(img)
+                dt = (time_synchronized() - t) / 20 * 1E3
+                print(f'{str(mode):>8s}{dt:10.1f}ms  max abs diff {(y - y0).abs().max():.2e}')
+        model.plan_concat(None)
 
     # Profile
     # img = torch.rand(8 if torch.cuda.is_available() else 1, 3, 640, 640).to(device)
@@ -0,0 +1,84 @@
+import argparse
+import os
+import sys
+from copy import deepcopy
+
+sys.path.append('./')  # to run '$ python *.py' files in subdirectories
+
+import torch
+
+from models.yolo import Model, Detect, IDetect, IAuxDetect
+from utils.general import check_file, set_logging
+
+
+def fold_implicit(head, detect):
+    # Fold IDetect/IAuxDetect ImplicitA/ImplicitM into the plain output convs of a deploy Detect, aux m2 is dropped
+    # im * (W (x + ia) + b) = (im * W) x + im * (b + W ia)
+    for i in range(detect.nl):
+        w, b = head.m[i].weight, head.m[i].bias
+        ia, im = head.ia[i].implicit.view(-1), head.im[i].implicit.view(-1)
+        detect.m[i].weight.copy_(w * im.view(-1, 1, 1, 1))
+        detect.m[i].bias.copy_((b + (w.flatten(1) * ia).sum(1)) * im)
+
+
+def reparameterize(weights, cfg, save='', img_size=640, tol=1e-3):
+    # Training checkpoint -> deploy checkpoint: map weights onto the deploy cfg, fold branches, drop aux heads, verify
+    ckpt = torch.load(weights, map_location='cpu')
+    train_model = (ckpt.get('ema') or ckpt['model']).float().eval()
+    model = Model(cfg, ch=3, nc=train_model.yaml['nc']).eval()
+
+    # Layers shared by both yamls keep their index, aux-only layers of the training cfg sit between them and the head
+    n = len(model.model) - 1  # deploy head index
+    sd, tsd = model.state_dict(), train_model.state_dict()
+    for i in range(n):
+        a, b = model.model[i], train_model.model[i]
+        assert type(a) is type(b) and a.f == b.f, f'layer {i}: {a.type} {a.f} does not match training {b.type} {b.f}'
+    csd = {k: v for k, v in tsd.items() if k in sd and v.shape == sd[k].shape and int(k.split('.')[1]) < n}
+    missing = [k for k in sd if int(k.split('.')[1]) < n and k not in csd and not k.endswith('num_batches_tracked')]
+    assert not missing, f'{len(missing)} deploy weights not found in {weights}, i.e. {missing[:3]}'
+    model.load_state_dict(csd, strict=False)
+
+    # Head
+    head, detect = train_model.model[-1], model.model[-1]
+    with torch.no_grad():
+        detect.anchors.copy_(head.anchors[:detect.nl])
+        detect.anchor_grid.copy_(head.anchor_grid[:detect.nl])
+        if type(detect) is Detect and isinstance(head, (IDetect, IAuxDetect)):
+            fold_implicit(head, detect)
+        else:  # same head type, aux m2/ia2/im2 are not part of the deploy head
+            hsd = {k: v for k, v in head.state_dict().items() if k in detect.state_dict()}
+            detect.load_state_dict(hsd, strict=False)
+        model.fuse()  # fold BatchNorm, RepConv, OREPA and any remaining implicit layers
+    model.names, model.stride = getattr(train_model, 'names', None), train_model.stride
+    model.model[-1].stride = train_model.model[-1].stride
+
+    # Verify
+    img = torch.rand(1, 3, img_size, img_size)
+    with torch.no_grad():
+        y0, y = train_model(img)[0], model(img)[0]
+    diff = ((y - y0).abs().max() / y0.abs().max()).item()
+    print(f'Max relative output difference {diff:.2e}')
+    assert diff < tol, f'deploy model output differs from training model by {diff:.2e} > {tol}'
+
+    # Save
+    save = save or weights.replace('.pt', '_deploy.pt')
+    model = deepcopy(model).half()
+    for p in model.parameters():
+        p.requires_grad = False
+    torch.save({'model': model, 'optimizer': None, 'training_results': None, 'epoch': -1}, save)
+    print(f'Deploy checkpoint saved as {save}, {os.path.getsize(weights) / 1E6:.1f}MB -> {os.path.getsize(save) / 1E6:.1f}MB')
+    return save
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='reparameterize.py')
+    parser.add_argument('--weights', type=str, default='yolov7_training.pt', help='training checkpoint path')
+    parser.add_argument('--cfg', type=str, default='cfg/deploy/yolov7.yaml', help='deploy model.yaml')
+    parser.add_argument('--save', type=str, default='', help='deploy checkpoint path, default *_deploy.pt')
+    parser.add_argument('--img-size', type=int, default=640, help='verification image size (pixels)')
+    parser.add_argument('--tol', type=float, default=1e-3, help='max relative output difference')
+    opt = parser.parse_args()
+    opt.cfg = check_file(opt.cfg)  # check file
+    print(opt)
+    set_logging()
+    reparameterize(opt.weights, opt.cfg, opt.save, opt.img_size, opt.tol)
@@ -10,9 +10,10 @@ import yaml
 from tqdm import tqdm
 
 from models.experimental import attempt_load
-from utils.datasets import create_dataloader
+from utils.datasets import create_dataloader, load_image, LoadImagesAndLabels
 from utils.general import coco80_to_coco91_class, check_dataset, check_file, check_img_size, check_requirements, \
-    box_iou, non_max_suppression, scale_coords, xyxy2xywh, xywh2xyxy, set_logging, increment_path, colorstr
+    box_iou, non_max_suppression, non_max_suppression_batched, scale_coords, xyxy2xywh, xywh2xyxy, set_logging, \
+    increment_path, colorstr, NMS_ENGINES, NMS_DEFAULT
 from utils.metrics import ap_per_class, ConfusionMatrix
 from utils.plots import plot_images, output_to_target, plot_study_txt
 from utils.torch_utils import select_device, time_synchronized, TracedModel
@@ -39,7 +40,9 @@ def test(data,
          compute_loss=None,
          half_precision=True,
          trace=False,
-         is_coco=False):
+         is_coco=False,
+         batched_nms=False,
+         nms_engine=NMS_DEFAULT):
     # Initialize/load model and set device
     training = model is not None
     if training:  # called by train.py
@@ -118,7 +121,8 @@ def test(data,
             targets[:, 2:] *= torch.Tensor([width, height, width, height]).to(device)  # to pixels
             lb = [targets[targets[:, 0] == i, 1:] for i in range(nb)] if save_hybrid else []  # for autolabelling
             t = time_synchronized()
-            out = non_max_suppression(out, conf_thres=conf_thres, iou_thres=iou_thres, labels=lb, multi_label=True)
+            nms = non_max_suppression_batched if batched_nms else non_max_suppression
+            out = nms(out, conf_thres=conf_thres, iou_thres=iou_thres, labels=lb, multi_label=True, engine=nms_engine)
             t1 += time_synchronized() - t
 
         # Statistics per image
@@ -283,6 +287,70 @@ def test(data,
     return (mp, mr, map50, map, *(loss.cpu() / len(dataloader)).tolist()), maps, t
 
 
+def nms_benchmark(batch_size=32, imgsz=640, nc=80, conf_thres=0.001, iou_thres=0.65, n=10, device='',
+                  counts=(100, 300, 1000, 3000)):
+    # Compare per-image and batched NMS, then every NMS engine, on synthetic data, i.e. python test.py --task nms
+    device = select_device(device)
+    na = 3 * sum((imgsz // s) ** 2 for s in (8, 16, 32))  # anchors of a P5 model
+    pred = torch.rand(batch_size, na, nc + 5, device=device)
+    pred[..., :2] *= imgsz  # xy
+    pred[..., 2:4] = pred[..., 2:4] * imgsz / 4 + 4  # wh
+    pred[..., 4:] = torch.sigmoid(torch.randn(batch_size, na, nc + 1, device=device) * 1.5 - 8)  # mostly background
+    print(f"{'function':>30s}{'ms/batch':>12s}{'ms/img':>12s}{'dets':>10s}")
+    results = []
+    for f in (non_max_suppression, non_max_suppression_batched):
+        f(pred, conf_thres, iou_thres, multi_label=True)  # warmup
+        t = time_synchronized()
+        for _ in range(n):
+            out = f(pred, conf_thres, iou_thres, multi_label=True)
+        dt = (time_synchronized() - t) / n * 1E3
+        results.append(out)
+        print(f'{f.__name__:>30s}{dt:12.2f}{dt / batch_size:12.3f}{sum(len(x) for x in out):10g}')
+    match = all(len(a) == len(b) and torch.allclose(a, b) for a, b in zip(*results))
+    print(f"Batched NMS {'matches' if match else 'DIFFERS from'} per-image NMS")
+
+    # Engines, latency and agreement with greedy NMS at increasing candidate counts, on synthetic boxes only:
+    # use 'test.py --nms-engine X' for the mAP of engine X on real data
+    print(f"\n{'engine':>12s}{'boxes':>10s}{'ms':>12s}{'kept':>10s}{'recall':>10s}{'precision':>10s}")
+    for c in counts:
+        xy = torch.rand(c // 10 + 1, 2, device=device).repeat(10, 1)[:c] * imgsz  # ~10 boxes per object
+        xy += torch.randn(c, 2, device=device) * imgsz / 80  # jitter
+        boxes = torch.cat((xy, xy + torch.rand(c, 2, device=device) * imgsz / 8 + 4), 1)
+        scores = torch.rand(c, device=device)
+        ref = NMS_ENGINES[NMS_DEFAULT](boxes, scores, iou_thres)
+        ref = set(ref[scores[ref] > conf_thres].tolist())
+        for k, f in NMS_ENGINES.items():
+            t = time_synchronized()
+            for _ in range(n):
+                s = scores.clone()
+                i = f(boxes, s, iou_thres)
+            dt = (time_synchronized() - t) / n * 1E3
+            kept = set(i[s[i] > conf_thres].tolist())  # soft engines decay scores instead of removing boxes
+            tp = len(kept & ref)
+            print(f'{k:>12s}{c:10g}{dt:12.3f}{len(kept):10g}{tp / max(len(ref), 1):10.3f}{tp / max(len(kept), 1):10.3f}')
+    return match
+
+
+def loader_benchmark(path, imgsz=640, n=200):
+    # Dataset images/s with full and reduced-resolution JPEG decode, i.e. python test.py --task loader --data coco.yaml
+    dataset = LoadImagesAndLabels(path, imgsz)
+    n = min(n, len(dataset))
+    print(f"{'decode':>10s}{'images/s':>12s}{'load_image ms':>16s}{'mean |diff|':>14s}")
+    ref = None
+    for reduced in (False, True):
+        dataset.reduced_decode = reduced
+        t = time_synchronized()
+        imgs = [load_image(dataset, i) for i in range(n)]
+        dt = time_synchronized() - t
+        for i in range(n):
+            dataset[i]  # load_image + letterbox + labels
+        ips = n / (time_synchronized() - t - dt)
+        d = np.mean([np.abs(a[0].astype(np.float32) - b[0]).mean() for a, b in zip(ref, imgs)]) if ref else 0.
+        assert ref is None or all(a[1:] == b[1:] for a, b in zip(ref, imgs)), 'label geometry changed'
+        print(f"{'reduced' if reduced else 'full':>10s}{ips:12.1f}{dt / n * 1E3:16.2f}{d:14.2f}")
+        ref = imgs
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(prog='test.py')
     parser.add_argument('--weights', nargs='+', type=str, default='yolov7.pt', help='model.pt path(s)')
@@ -291,7 +359,7 @@ if __name__ == '__main__':
     parser.add_argument('--img-size', type=int, default=640, help='inference size (pixels)')
     parser.add_argument('--conf-thres', type=float, default=0.001, help='object confidence threshold')
     parser.add_argument('--iou-thres', type=float, default=0.65, help='IOU threshold for NMS')
-    parser.add_argument('--task', default='val', help='train, val, test, speed or study')
+    parser.add_argument('--task', default='val', help='train, val, test, speed, study, nms or loader')
     parser.add_argument('--device', default='', help='cuda device, i.e. 0 or 0,1,2,3 or cpu')
     parser.add_argument('--single-cls', action='store_true', help='treat as single-class dataset')
     parser.add_argument('--augment', action='store_true', help='augmented inference')
@@ -304,6 +372,8 @@ if __name__ == '__main__':
     parser.add_argument('--name', default='exp', help='save to project/name')
     parser.add_argument('--exist-ok', action='store_true', help='existing project/name ok, do not increment')
     parser.add_argument('--no-trace', action='store_true', help='don`t trace model')
+    parser.add_argument('--batched-nms', action='store_true', help='run NMS for the whole batch at once')
+    parser.add_argument('--nms-engine', default=NMS_DEFAULT, choices=list(NMS_ENGINES), help='NMS implementation')
     opt = parser.parse_args()
     opt.save_json |= opt.data.endswith('coco.yaml')
     opt.data = check_file(opt.data)  # check file
@@ -325,6 +395,8 @@ if __name__ == '__main__':
              save_hybrid=opt.save_hybrid,
              save_conf=opt.save_conf,
              trace=not opt.no_trace,
+             batched_nms=opt.batched_nms,
+             nms_engine=opt.nms_engine,
              )
 
     elif opt.task == 'speed':  # speed benchmarks
@@ -345,3 +417,13 @@ if __name__ == '__main__':
             np.savetxt(f, y, fmt='%10.4g')  # save
         os.system('zip -r study.zip study_*.txt')
         plot_study_txt(x=x)  # plot
+
+    elif opt.task == 'loader':  # dataset decode benchmarks
+        # python test.py --task loader --data coco.yaml --img-size 640
+        with open(opt.data) as f:
+            loader_benchmark(yaml.load(f, Loader=yaml.SafeLoader)['val'], opt.img_size)
+
+    elif opt.task == 'nms':  # NMS benchmarks
+        # python test.py --task nms --batch-size 32 --img-size 640
+        nms_benchmark(opt.batch_size, opt.img_size, conf_thres=opt.conf_thres, iou_thres=opt.iou_thres,
+                      device=opt.device)
@@ -0,0 +1,102 @@
+import argparse
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+sys.path.append('./')  # to run '$ python *.py' files in subdirectories
+
+import cv2
+import numpy as np
+import torch
+import yaml
+
+from models.experimental import attempt_load
+from models.yolo import Model
+from utils.datasets import letterbox
+from utils.torch_utils import set_threads, time_synchronized
+
+
+def capture_load(cores, stop, frame=(1080, 1920)):
+    # Stand-in for the camera thread: decode-sized work on the capture cores while the pipeline is timed
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores)
+    im = np.random.randint(0, 255, (*frame, 3), dtype=np.uint8)
+    while not stop.is_set():
+        cv2.cvtColor(cv2.resize(im, frame[::-1]), cv2.COLOR_BGR2RGB)
+
+
+def run_config(c, weights, imgsz, n, capture):
+    # Time preprocessing and forward for one configuration, runs in a fresh process so every setting applies
+    set_threads(c['threads'], c['interop_threads'], c['cores'])
+    cv2.setNumThreads(c['cv2_threads'])
+    model = attempt_load(weights, map_location='cpu') if weights.endswith('.pt') else Model(weights).fuse().eval()
+    stride = int(model.stride.max())
+    im0 = np.random.randint(0, 255, (1080, 1920, 3), dtype=np.uint8)
+
+    stop = threading.Event()
+    if capture:
+        threading.Thread(target=capture_load, args=(c['capture_cores'], stop), daemon=True).start()
+    tp, tf = [], []
+    with torch.no_grad():
+        for i in range(n + 3):  # 3 warmup iterations
+            t0 = time_synchronized()
+            img = letterbox(im0, imgsz, stride=stride)[0][:, :, ::-1].transpose(2, 0, 1)  # BGR to RGB, to 3xhxw
+            img = torch.from_numpy(np.ascontiguousarray(img)).float()[None] / 255.0
+            t1 = time_synchronized()
+            model(img)
+            t2 = time_synchronized()
+            if i >= 3:
+                tp.append((t1 - t0) * 1E3)
+                tf.append((t2 - t1) * 1E3)
+    stop.set()
+    return float(np.median(tp)), float(np.median(tf))
+
+
+def configs(cores, capture_cores, interop=(1, 2)):
+    # Candidate (affinity, threads, interop, cv2 threads) settings, inference cores kept apart from capture cores
+    pool = [x for x in cores if x not in capture_cores] or cores
+    sets = [pool[:k] for k in range(1, len(pool) + 1)]
+    if pool != cores:
+        sets.append(cores)  # no isolation, for reference
+    for s in sets:
+        for t in sorted({max(len(s) // 2, 1), len(s)}):
+            for i in interop:
+                for c in sorted({1, t}):
+                    yield {'cores': s, 'threads': t, 'interop_threads': i, 'cv2_threads': c,
+                           'capture_cores': capture_cores}
+
+
+def tune(opt):
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    capture_cores = opt.capture_cores if opt.capture_cores is not None else cores[-1:] if len(cores) > 1 else []
+    print(f"{'cores':>24s}{'threads':>9s}{'interop':>9s}{'cv2':>5s}{'pre (ms)':>10s}{'fwd (ms)':>10s}{'total':>10s}")
+    results = []
+    for c in configs(cores, capture_cores, opt.interop):
+        with ProcessPoolExecutor(1, mp_context=get_context('spawn')) as ex:
+            tp, tf = ex.submit(run_config, c, opt.weights, opt.img_size, opt.n, not opt.no_capture).result()
+        c.update(preprocess_ms=round(tp, 2), forward_ms=round(tf, 2), latency_ms=round(tp + tf, 2))
+        results.append(c)
+        print(f"{str(c['cores']):>24s}{c['threads']:9d}{c['interop_threads']:9d}{c['cv2_threads']:5d}"
+              f"{tp:10.1f}{tf:10.1f}{tp + tf:10.1f}")
+
+    best = min(results, key=lambda x: x['latency_ms'])
+    with open(opt.out, 'w') as f:
+        yaml.safe_dump(best, f, sort_keys=False)
+    print(f'Best {best} saved to {opt.out}, run the node with --threads-profile {opt.out}')
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(prog='tune_threads.py')
+    parser.add_argument('--weights', type=str, default='yolov7-tiny.pt', help='model.pt or model.yaml path')
+    parser.add_argument('--img-size', type=int, default=640, help='inference size (pixels)')
+    parser.add_argument('--capture-cores', nargs='*', type=int, help='cores reserved for the camera thread')
+    parser.add_argument('--interop', nargs='+', type=int, default=[1, 2], help='inter-op thread counts to try')
+    parser.add_argument('--n', type=int, default=20, help='timed iterations per configuration')
+    parser.add_argument('--no-capture', action='store_true', help='do not simulate the capture thread')
+    parser.add_argument('--out', type=str, default='threads.yaml', help='where to save the best configuration')
+    opt = parser.parse_args()
+    print(opt)
+    tune(opt)
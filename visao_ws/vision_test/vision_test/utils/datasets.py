@@ -1,13 +1,17 @@
 # Dataset utils and dataloaders
 
 import glob
+import hashlib
+import io
 import logging
 import math
 import os
 import random
 import shutil
+import tarfile
 import time
-from itertools import repeat
+from itertools import islice, repeat
+from multiprocessing import Pool
 from multiprocessing.pool import ThreadPool
 from pathlib import Path
 from threading import Thread
@@ -17,7 +21,7 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from PIL import Image, ExifTags
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, IterableDataset
 from tqdm import tqdm
 
 import pickle
@@ -63,31 +67,50 @@ def exif_size(img):
 
 
 def create_dataloader(path, imgsz, batch_size, stride, opt, hyp=None, augment=False, cache=False, pad=0.0, rect=False,
-                      rank=-1, world_size=1, workers=8, image_weights=False, quad=False, prefix=''):
+                      rank=-1, world_size=1, workers=8, image_weights=False, quad=False, prefix='', batch_augment=False,
+                      bucket=False):
     # Make sure only the first process in DDP process the dataset first, and the following others can use the cache
     with torch_distributed_zero_first(rank):
+        if isinstance(path, str) and os.path.isfile(os.path.join(path, 'shards.npz')):  # see make_shards()
+            # Shards are streamed in order: no random access for image weights, rect or bucket batches, or caching
+            bad = [k for k, v in (('--image-weights', image_weights), ('--rect', rect and augment),
+                                  ('--ar-buckets', bucket), ('--cache-images', cache)) if v]
+            assert not bad, f'{prefix}{" ".join(bad)} not supported with tar shards {path}, see LoadShards'
+            dataset = LoadShards(path, imgsz, augment=augment, hyp=hyp, single_cls=opt.single_cls, rank=rank,
+                                 world_size=world_size, prefix=prefix, batch_augment=batch_augment,
+                                 batch_size=batch_size)
+            nw = min([os.cpu_count() // world_size, batch_size if batch_size > 1 else 0, workers])  # number of workers
+            return torch.utils.data.DataLoader(dataset, batch_size=min(batch_size, len(dataset)), num_workers=nw,
+                                               pin_memory=True, persistent_workers=nw > 0,
+                                               collate_fn=LoadImagesAndLabels.collate_fn4 if quad else
+                                               LoadImagesAndLabels.collate_fn), dataset
         dataset = LoadImagesAndLabels(path, imgsz, batch_size,
                                       augment=augment,  # augment images
                                       hyp=hyp,  # augmentation hyperparameters
-                                      rect=rect,  # rectangular training
+                                      rect=rect or bucket,  # rectangular training
                                       cache_images=cache,
                                       single_cls=opt.single_cls,
                                       stride=int(stride),
                                       pad=pad,
                                       image_weights=image_weights,
-                                      prefix=prefix)
+                                      prefix=prefix,
+                                      batch_augment=batch_augment)
 
     batch_size = min(batch_size, len(dataset))
     nw = min([os.cpu_count() // world_size, batch_size if batch_size > 1 else 0, workers])  # number of workers
-    sampler = torch.utils.data.distributed.DistributedSampler(dataset) if rank != -1 else None
+    if bucket:  # aspect ratio buckets, letterbox shape per batch
+        sampler = dict(batch_sampler=AspectRatioBatchSampler(dataset, batch_size, pad=pad, rank=rank,
+                                                             world_size=world_size))
+    else:
+        sampler = dict(batch_size=batch_size,
+                       sampler=torch.utils.data.distributed.DistributedSampler(dataset) if rank != -1 else None)
     loader = torch.utils.data.DataLoader if image_weights else InfiniteDataLoader
     # Use torch.utils.data.DataLoader() if dataset.properties will update during training else InfiniteDataLoader()
     dataloader = loader(dataset,
-                        batch_size=batch_size,
                         num_workers=nw,
-                        sampler=sampler,
                         pin_memory=True,
-                        collate_fn=LoadImagesAndLabels.collate_fn4 if quad else LoadImagesAndLabels.collate_fn)
+                        collate_fn=LoadImagesAndLabels.collate_fn4 if quad else LoadImagesAndLabels.collate_fn,
+                        **sampler)
     return dataloader, dataset
 
 
@@ -125,6 +148,54 @@ class _RepeatSampler(object):
             yield from iter(self.sampler)
 
 
+class AspectRatioBatchSampler(torch.utils.data.Sampler):
+    """ Batch sampler that groups images of similar aspect ratio
+
+    Images are split into aspect ratio quantile buckets, shuffled and batched within each bucket, and the batches are
+    shuffled across buckets every epoch. Yields [(index, (h, w)), ...] with the batch letterbox shape, see rect_shape()
+    """
+
+    def __init__(self, dataset, batch_size, buckets=8, shuffle=True, pad=0.0, rank=-1, world_size=1, seed=0):
+        self.ar = dataset.shapes[:, 1] / dataset.shapes[:, 0]  # aspect ratio h/w
+        self.img_size, self.stride, self.pad = dataset.img_size, dataset.stride, pad
+        self.batch_size, self.shuffle, self.seed, self.epoch = batch_size, shuffle, seed, 0
+        self.rank, self.world_size = max(rank, 0), world_size if rank != -1 else 1
+        n = len(self.ar)
+        self.buckets = np.minimum(self.ar.argsort(kind='stable').argsort() * buckets // max(n, 1), buckets - 1)
+        sizes = np.bincount(self.buckets, minlength=buckets)
+        self.nb = int((sizes // batch_size).sum()) + math.ceil((sizes % batch_size).sum() / batch_size)  # batches
+
+    def __len__(self):
+        return math.ceil(self.nb / self.world_size)  # batches per rank
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)  # same order on every rank
+        self.epoch += 1
+        bs, batches, rest = self.batch_size, [], []
+        for b in range(self.buckets.max() + 1 if len(self.buckets) else 0):
+            i = np.flatnonzero(self.buckets == b)
+            if self.shuffle:
+                rng.shuffle(i)
+            k = len(i) // bs * bs
+            batches.extend(i[:k].reshape(-1, bs))
+            rest.append(i[k:])  # leftovers of neighbouring buckets are batched together
+        rest = np.concatenate(rest) if rest else []
+        batches.extend(rest[j:j + bs] for j in range(0, len(rest), bs))
+        if self.shuffle:
+            batches = [batches[j] for j in rng.permutation(len(batches))]
+        batches += batches[:len(self) * self.world_size - len(batches)]  # same number of batches on every rank
+        for b in batches[self.rank::self.world_size]:
+            shape = tuple(rect_shape(self.ar[b], self.img_size, self.stride, self.pad).tolist())
+            yield [(int(i), shape) for i in b]
+
+
+def rect_shape(ar, img_size, stride=32, pad=0.0):
+    # Letterbox shape (h, w) for a batch of images with aspect ratios ar (h/w)
+    mini, maxi = ar.min(), ar.max()
+    shape = [maxi, 1] if maxi < 1 else [1, 1 / mini] if mini > 1 else [1, 1]
+    return np.ceil(np.array(shape) * img_size / stride + pad).astype(int) * stride
+
+
 class LoadImages:  # for inference
     def __init__(self, path, img_size=640, stride=32):
         p = str(Path(path).absolute())  # os-agnostic absolute path
@@ -350,16 +421,296 @@ def img2label_paths(img_paths):
     return ['txt'.join(x.replace(sa, sb, 1).rsplit(x.split('.')[-1], 1)) for x in img_paths]
 
 
+def scan_dir(path):
+    # Image files under path, recursive os.scandir walk (no per-file stat or glob pattern matching).
+    # Hidden names (e.g. macOS ._x.jpg) are skipped like glob('*.*'), symlinked dirs are entered once by real path
+    files, dirs, seen = [], [str(path)], {os.path.realpath(path)}
+    while dirs:
+        with os.scandir(dirs.pop()) as it:
+            for e in it:
+                if e.name.startswith('.'):
+                    continue
+                if e.is_dir(follow_symlinks=True):
+                    r = os.path.realpath(e.path)
+                    if r not in seen:  # symlink cycles and duplicate links
+                        seen.add(r)
+                        dirs.append(e.path)
+                elif e.name.rsplit('.', 1)[-1].lower() in img_formats:
+                    files.append(e.path)
+    return files
+
+
+def file_stat(f):
+    # (size, mtime_ns) of a file, (-1, -1) if it does not exist
+    try:
+        st = os.stat(f)
+        return st.st_size, st.st_mtime_ns
+    except OSError:
+        return -1, -1
+
+
+def verify_image_label(args):
+    # Verify one image-label pair, returns im_file, labels, shape, segments, status (0 found, 1 empty, 2 missing,
+    # 3 corrupted) and a warning message
+    im_file, lb_file, prefix = args
+    try:
+        # verify images
+        im = Image.open(im_file)
+        im.verify()  # PIL verify
+        shape = exif_size(im)  # image size
+        segments = []  # instance segments
+        assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
+        assert im.format.lower() in img_formats, f'invalid image format {im.format}'
+
+        # verify labels
+        if os.path.isfile(lb_file):
+            status = 0  # label found
+            with open(lb_file, 'r') as f:
+                l, segments = parse_labels(f.read())
+            if len(l):
+                assert l.shape[1] == 5, 'labels require 5 columns each'
+                assert (l >= 0).all(), 'negative labels'
+                assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
+                assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
+            else:
+                status = 1  # label empty
+                l = np.zeros((0, 5), dtype=np.float32)
+        else:
+            status = 2  # label missing
+            l = np.zeros((0, 5), dtype=np.float32)
+        return im_file, l, shape, segments, status, ''
+    except Exception as e:
+        return im_file, np.zeros((0, 5), dtype=np.float32), (0, 0), [], 3, \
+            f'{prefix}WARNING: Ignoring corrupted image and/or label {im_file}: {e}'
+
+
+def parse_labels(text):
+    # Label file rows to (cls, xywh) labels and segments, boxes of segment rows come from their polygons
+    l, segments = [x.split() for x in text.strip().splitlines()], []
+    if any([len(x) > 8 for x in l]):  # is segment
+        classes = np.array([x[0] for x in l], dtype=np.float32)
+        segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
+        l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
+    return np.array(l, dtype=np.float32), segments
+
+
+def save_label_cache(path, entries, version):
+    # Columnar label cache: {im_file: (labels, shape, segments, status, stat)} flattened into a few numpy arrays
+    files = list(entries.keys())
+    e = list(entries.values())
+    segments = [s for x in e for s in x[2]]
+    with open(path, 'wb') as f:  # file object, np.savez would otherwise append .npz
+        np.savez(f, version=np.array(version),
+                 files=np.frombuffer('\n'.join(files).encode(), dtype=np.uint8),
+                 labels=np.concatenate([x[0] for x in e], 0) if e else np.zeros((0, 5), dtype=np.float32),
+                 nl=np.array([len(x[0]) for x in e], dtype=np.int32),
+                 shapes=np.array([x[1] for x in e], dtype=np.int32).reshape(-1, 2),
+                 status=np.array([x[3] for x in e], dtype=np.int8),
+                 stat=np.array([x[4] for x in e], dtype=np.int64).reshape(-1, 4),
+                 ns=np.array([len(x[2]) for x in e], dtype=np.int32),  # segments per image
+                 np_=np.array([len(x) for x in segments], dtype=np.int32),  # points per segment
+                 xy=np.concatenate(segments, 0) if segments else np.zeros((0, 2), dtype=np.float32))
+
+
+def load_label_cache(path, version):
+    # Inverse of save_label_cache(), {} for a missing, unreadable (i.e. old pickled) or other-version cache
+    try:
+        with np.load(path) as x:
+            if x['version'].item() != version:
+                return {}
+            x = dict(x)
+    except Exception:
+        return {}
+    files = x['files'].tobytes().decode().split('\n') if len(x['files']) else []
+    labels = np.split(x['labels'], np.cumsum(x['nl'])[:-1]) if files else []
+    segments = np.split(x['xy'], np.cumsum(x['np_'])[:-1]) if len(x['np_']) else []
+    segments = [segments[j - n:j] for n, j in zip(x['ns'], np.cumsum(x['ns']))]  # per image
+    return {f: (l, tuple(s), sg, int(st), a) for f, l, s, sg, st, a in
+            zip(files, labels, x['shapes'].tolist(), segments, x['status'], x['stat'])}
+
+
+class Ragged:
+    # CSR-style sequence of arrays: one flat array plus int64 offsets, items are views into the flat array
+    # Forked DataLoader workers then share a handful of large buffers instead of refcounting 1 object per image
+    def __init__(self, arrays=(), data=None, offsets=None, tail=(5,), dtype=np.float32):
+        if data is None:
+            arrays = list(arrays)
+            data = np.concatenate(arrays, 0).astype(dtype, copy=False) if arrays else np.zeros((0, *tail), dtype)
+            offsets = np.cumsum([0] + [len(x) for x in arrays], dtype=np.int64)
+        self.data, self.offsets = data, offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def take(self, indices):
+        # New Ragged with items in the order of indices
+        indices = np.asarray(indices)
+        n = self.offsets[indices + 1] - self.offsets[indices]
+        idx = np.repeat(self.offsets[indices] - np.cumsum(n) + n, n) + np.arange(n.sum())  # flat element indices
+        return Ragged(data=self.data[idx], offsets=np.concatenate(([0], np.cumsum(n))).astype(np.int64))
+
+
+class RaggedSegments:
+    # Per-image lists of (n,2) segments as two nested Ragged levels, items are lists of views
+    def __init__(self, segments=()):
+        segments = list(segments)
+        self.points = Ragged([x for s in segments for x in s], tail=(2,))  # all segments, flat
+        self.offsets = np.cumsum([0] + [len(s) for s in segments], dtype=np.int64)  # segments of each image
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return [self.points[j] for j in range(self.offsets[i], self.offsets[i + 1])]
+
+    def take(self, indices):
+        # New RaggedSegments with items in the order of indices
+        return RaggedSegments(self[i] for i in indices)
+
+
+class PackedStrings:
+    # Strings packed into one utf-8 byte array with int64 offsets
+    def __init__(self, strings=()):
+        b = [x.encode() for x in strings]
+        self.data = np.frombuffer(b''.join(b), dtype=np.uint8)
+        self.offsets = np.cumsum([0] + [len(x) for x in b], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode()
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class ImageStore:
+    # Resized images packed back to back into memory-mapped uint8 shards, indexed by (shard, offset, h, w, h0, w0)
+    # Pages are read straight from the OS page cache, so DataLoader workers and DDP ranks share one copy
+    def __init__(self, path):
+        self.path = Path(path)
+        self.index = np.load(self.path / 'index.npy')
+        self.shards = None  # opened lazily in every process
+
+    def __getstate__(self):
+        return {'path': self.path, 'index': self.index, 'shards': None}  # do not pickle the mapped data
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, i):
+        # img (view, copy-on-write), hw_original, hw_resized
+        if self.shards is None:
+            self.shards = [np.memmap(f, dtype=np.uint8, mode='c') for f in sorted(self.path.glob('shard*.bin'))]
+        k, o, h, w, h0, w0 = self.index[i].tolist()
+        return self.shards[k][o:o + h * w * 3].reshape(h, w, 3), (h0, w0), (h, w)
+
+    @staticmethod
+    def open(path, key):
+        # Existing store built for the same files, img_size and augment setting, else None
+        try:
+            with open(Path(path) / 'key.txt') as f:
+                return ImageStore(path) if f.read() == key else None
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def build(path, key, images, n, prefix='', shard_bytes=2 ** 32):
+        # Write (img, hw_original) pairs from an iterator, decoded in parallel by the caller, into new shards
+        path = Path(path)
+        shutil.rmtree(path, ignore_errors=True)
+        path.mkdir(parents=True)
+        index, k, o, f = np.zeros((n, 6), dtype=np.int64), 0, 0, None
+        pbar = tqdm(images, total=n)
+        for i, (img, (h0, w0)) in enumerate(pbar):
+            if f is None or o + img.nbytes > shard_bytes:
+                if f:
+                    f.close()
+                    k += 1
+                f, o = open(path / f'shard{k:04d}.bin', 'wb'), 0
+            f.write(np.ascontiguousarray(img).data)
+            index[i] = k, o, img.shape[0], img.shape[1], h0, w0
+            o += img.nbytes
+            pbar.desc = f'{prefix}Caching images ({(k * shard_bytes + o) / 1E9:.1f}GB store)'
+        f.close()
+        np.save(path / 'index.npy', index)
+        with open(path / 'key.txt', 'w') as f:  # written last, marks the store complete
+            f.write(key)
+        return ImageStore(path)
+
+
+class PatchBank:
+    # Object patches (BGR + mask channel) packed back to back into one memory-mapped file, indexed by (offset, h, w, cls)
+    def __init__(self, path):
+        self.path = Path(path)
+        self.index = np.load(self.path / 'index.npy')
+        self.data = None  # opened lazily in every process
+
+    def __getstate__(self):
+        return {'path': self.path, 'index': self.index, 'data': None}  # do not pickle the mapped data
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        # cls, img (h,w,3), mask (h,w), read-only views
+        if self.data is None:
+            self.data = np.memmap(self.path / 'patches.bin', dtype=np.uint8, mode='r')
+        o, h, w, c = self.index[i].tolist()
+        x = self.data[o:o + h * w * 4].reshape(h, w, 4)
+        return c, x[..., :3], x[..., 3]
+
+    @staticmethod
+    def open(path, key):
+        # Existing bank cut from the same files at the same img_size, else None
+        try:
+            with open(Path(path) / 'key.txt') as f:
+                return PatchBank(path) if f.read() == key else None
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def build(path, key, patches, n, prefix=''):
+        # Write per-image lists of (cls, patch(h,w,4)) from an iterator, cut in parallel by the caller
+        path = Path(path)
+        shutil.rmtree(path, ignore_errors=True)
+        path.mkdir(parents=True)
+        index, o = [], 0
+        with open(path / 'patches.bin', 'wb') as f:
+            pbar = tqdm(patches, total=n)
+            for x in pbar:
+                for c, p in x:
+                    f.write(p.data)
+                    index.append((o, p.shape[0], p.shape[1], c))
+                    o += p.nbytes
+                pbar.desc = f'{prefix}Cutting paste_in patches ({len(index)} patches, {o / 1E9:.2f}GB)'
+        np.save(path / 'index.npy', np.array(index, dtype=np.int64).reshape(-1, 4))
+        with open(path / 'key.txt', 'w') as f:  # written last, marks the bank complete
+            f.write(key)
+        return PatchBank(path)
+
+
 class LoadImagesAndLabels(Dataset):  # for training/testing
+    reduced_decode = True  # decode large JPEGs at a reduced scale, see imread_reduced()
+
     def __init__(self, path, img_size=640, batch_size=16, augment=False, hyp=None, rect=False, image_weights=False,
-                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix=''):
+                 cache_images=False, single_cls=False, stride=32, pad=0.0, prefix='', batch_augment=False):
         self.img_size = img_size
         self.augment = augment
+        self.batch_augment = batch_augment and augment and not rect  # image space augmentation in BatchAugment
         self.hyp = hyp
         self.image_weights = image_weights
         self.rect = False if image_weights else rect
         self.mosaic = self.augment and not self.rect  # load 4 images at a time into a mosaic (only during training)
         self.mosaic_border = [-img_size // 2, -img_size // 2]
+        self.canvas = {}  # reusable mosaic canvases by shape, one set per DataLoader worker
         self.stride = stride
         self.path = path        
         #self.albumentations = Albumentations() if augment else None
@@ -369,7 +720,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             for p in path if isinstance(path, list) else [path]:
                 p = Path(p)  # os-agnostic
                 if p.is_dir():  # dir
-                    f += glob.glob(str(p / '**' / '*.*'), recursive=True)
+                    f += scan_dir(p)
                     # f = list(p.rglob('**/*.*'))  # pathlib
                 elif p.is_file():  # file
                     with open(p, 'r') as t:
@@ -388,12 +739,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         # Check cache
         self.label_files = img2label_paths(self.img_files)  # labels
         cache_path = (p if p.is_file() else Path(self.label_files[0]).parent).with_suffix('.cache')  # cached labels
-        if cache_path.is_file():
-            cache, exists = torch.load(cache_path), True  # load
-            #if cache['hash'] != get_hash(self.label_files + self.img_files) or 'version' not in cache:  # changed
-            #    cache, exists = self.cache_labels(cache_path, prefix), False  # re-cache
-        else:
-            cache, exists = self.cache_labels(cache_path, prefix), False  # cache
+        cache, exists = self.cache_labels(cache_path, prefix)  # only new or modified files are verified
 
         # Display cache
         nf, nm, ne, nc, n = cache.pop('results')  # found, missing, empty, corrupted, total
@@ -403,19 +749,17 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         assert nf > 0 or not augment, f'{prefix}No labels in {cache_path}. Can not train without labels. See {help_url}'
 
         # Read cache
-        cache.pop('hash')  # remove hash
-        cache.pop('version')  # remove version
-        labels, shapes, self.segments = zip(*cache.values())
-        self.labels = list(labels)
+        labels, shapes, segments = zip(*cache.values())
+        self.labels = Ragged(labels)  # CSR, views share one flat array
+        self.segments = RaggedSegments(segments)
         self.shapes = np.array(shapes, dtype=np.float64)
-        self.img_files = list(cache.keys())  # update
-        self.label_files = img2label_paths(cache.keys())  # update
+        self.img_files = PackedStrings(cache.keys())  # update
+        self.label_files = PackedStrings(img2label_paths(cache.keys()))  # update
         if single_cls:
-            for x in self.labels:
-                x[:, 0] = 0
+            self.labels.data[:, 0] = 0
 
         n = len(shapes)  # number of images
-        bi = np.floor(np.arange(n) / batch_size).astype(np.int)  # batch index
+        bi = np.floor(np.arange(n) / batch_size).astype(int)  # batch index
         nb = bi[-1] + 1  # number of batches
         self.batch = bi  # batch index of image
         self.n = n
@@ -427,100 +771,99 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             s = self.shapes  # wh
             ar = s[:, 1] / s[:, 0]  # aspect ratio
             irect = ar.argsort()
-            self.img_files = [self.img_files[i] for i in irect]
-            self.label_files = [self.label_files[i] for i in irect]
-            self.labels = [self.labels[i] for i in irect]
+            self.img_files = PackedStrings(self.img_files[i] for i in irect)
+            self.label_files = PackedStrings(self.label_files[i] for i in irect)
+            self.labels = self.labels.take(irect)
+            self.segments = self.segments.take(irect)
             self.shapes = s[irect]  # wh
             ar = ar[irect]
 
             # Set training image shapes
-            shapes = [[1, 1]] * nb
-            for i in range(nb):
-                ari = ar[bi == i]
-                mini, maxi = ari.min(), ari.max()
-                if maxi < 1:
-                    shapes[i] = [maxi, 1]
-                elif mini > 1:
-                    shapes[i] = [1, 1 / mini]
-
-            self.batch_shapes = np.ceil(np.array(shapes) * img_size / stride + pad).astype(np.int) * stride
+            self.batch_shapes = np.array([rect_shape(ar[bi == i], img_size, stride, pad) for i in range(nb)])
 
         # Cache images into memory for faster training (WARNING: large datasets may exceed system RAM)
         self.imgs = [None] * n
-        if cache_images:
-            if cache_images == 'disk':
-                self.im_cache_dir = Path(Path(self.img_files[0]).parent.as_posix() + '_npy')
-                self.img_npy = [self.im_cache_dir / Path(f).with_suffix('.npy').name for f in self.img_files]
-                self.im_cache_dir.mkdir(parents=True, exist_ok=True)
+        self.store = None
+        if cache_images == 'disk':  # memory-mapped image store, pages shared by all workers and ranks
+            store_dir = Path(Path(self.img_files[0]).parent.as_posix() + '_store')
+            key = f'{img_size} {self.augment} ' + ' '.join(f'{f} {file_stat(f)}' for f in self.img_files)
+            key = hashlib.sha1(key.encode()).hexdigest()  # files, their (size, mtime), img_size and interpolation
+            self.store = ImageStore.open(store_dir, key)
+            if self.store is None:
+                self.store = ImageStore.build(store_dir, key, ThreadPool(8).imap(lambda x: load_image(*x)[:2],
+                                              zip(repeat(self), range(n))), n, prefix)
+        elif cache_images:
             gb = 0  # Gigabytes of cached images
             self.img_hw0, self.img_hw = [None] * n, [None] * n
             results = ThreadPool(8).imap(lambda x: load_image(*x), zip(repeat(self), range(n)))
             pbar = tqdm(enumerate(results), total=n)
             for i, x in pbar:
-                if cache_images == 'disk':
-                    if not self.img_npy[i].exists():
-                        np.save(self.img_npy[i].as_posix(), x[0])
-                    gb += self.img_npy[i].stat().st_size
-                else:
-                    self.imgs[i], self.img_hw0[i], self.img_hw[i] = x
-                    gb += self.imgs[i].nbytes
+                self.imgs[i], self.img_hw0[i], self.img_hw[i] = x
+                gb += self.imgs[i].nbytes
                 pbar.desc = f'{prefix}Caching images ({gb / 1E9:.1f}GB)'
             pbar.close()
 
-    def cache_labels(self, path=Path('./labels.cache'), prefix=''):
-        # Cache dataset labels, check images and read shapes
-        x = {}  # dict
-        nm, nf, ne, nc = 0, 0, 0, 0  # number missing, found, empty, duplicate
-        pbar = tqdm(zip(self.img_files, self.label_files), desc='Scanning images', total=len(self.img_files))
-        for i, (im_file, lb_file) in enumerate(pbar):
+        # Object patches for paste_in, cut once instead of decoding images for every pasted sample
+        self.patches = None
+        if augment and hyp and hyp.get('paste_in') and len(self.segments.points):
+            key = f'{img_size} {single_cls} ' + ' '.join(f'{f} {file_stat(f)} {file_stat(lb)}' for f, lb in
+                                                         sorted(zip(self.img_files, self.label_files)))
+            key = hashlib.sha1(key.encode()).hexdigest()  # image and label files, their (size, mtime), img_size, single_cls
+            bank_dir = Path(Path(self.img_files[0]).parent.as_posix() + f'_patches_{key[:8]}')  # one bank per key
+            self.patches = PatchBank.open(bank_dir, key)
+            if self.patches is None:
+                self.patches = PatchBank.build(bank_dir, key, ThreadPool(8).imap(lambda x: cut_patches(*x),
+                                               zip(repeat(self), range(n))), n, prefix)
+
+    def cache_labels(self, path=Path('./labels.cache'), prefix='', version=0.2):
+        # Cache dataset labels, check images and read shapes. Entries are keyed by the (size, mtime) of the image and
+        # label files, so only added or modified pairs are verified again. Returns (cache, whether cache was current)
+        old = load_label_cache(path, version)
+        entries, todo = {}, []
+        for im_file, lb_file in zip(self.img_files, self.label_files):
+            stat = file_stat(im_file) + file_stat(lb_file)
+            e = old.get(im_file)
+            if e is not None and tuple(e[4]) == stat:
+                entries[im_file] = e
+            else:
+                todo.append((im_file, lb_file, stat))
+
+        if todo:  # verify in a process pool, chunked, results in any order
+            stats = {x[0]: x[2] for x in todo}
+            n = [0, 0, 0, 0]  # found, empty, missing, corrupted
+            nw = min(os.cpu_count() or 1, max(len(todo) // 64, 1))  # workers
+            t = time.time()
+            with Pool(nw) as pool:
+                results = pool.imap_unordered(verify_image_label, [(f, lb, prefix) for f, lb, _ in todo],
+                                              chunksize=max(len(todo) // (nw * 16), 1))
+                pbar = tqdm(results, desc='Scanning images', total=len(todo))
+                for im_file, l, shape, segments, status, msg in pbar:
+                    entries[im_file] = (l, shape, segments, status, stats[im_file])
+                    n[status] += 1
+                    if msg:
+                        print(msg)
+                    pbar.desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels... " \
+                                f"{n[0] + n[1]} found, {n[2]} missing, {n[1]} empty, {n[3]} corrupted"
+                pbar.close()
+            dt = time.time() - t
+            logging.info(f'{prefix}Verified {len(todo)} of {len(self.img_files)} images with {nw} workers '
+                         f'in {dt:.1f}s ({len(todo) / max(dt, 1E-6):.0f} images/s)')
+            entries = {f: entries[f] for f in self.img_files if f in entries}  # back to file order
+        current = not todo and len(entries) == len(old)
+        if not current:
             try:
-                # verify images
-                im = Image.open(im_file)
-                im.verify()  # PIL verify
-                shape = exif_size(im)  # image size
-                segments = []  # instance segments
-                assert (shape[0] > 9) & (shape[1] > 9), f'image size {shape} <10 pixels'
-                assert im.format.lower() in img_formats, f'invalid image format {im.format}'
-
-                # verify labels
-                if os.path.isfile(lb_file):
-                    nf += 1  # label found
-                    with open(lb_file, 'r') as f:
-                        l = [x.split() for x in f.read().strip().splitlines()]
-                        if any([len(x) > 8 for x in l]):  # is segment
-                            classes = np.array([x[0] for x in l], dtype=np.float32)
-                            segments = [np.array(x[1:], dtype=np.float32).reshape(-1, 2) for x in l]  # (cls, xy1...)
-                            l = np.concatenate((classes.reshape(-1, 1), segments2boxes(segments)), 1)  # (cls, xywh)
-                        l = np.array(l, dtype=np.float32)
-                    if len(l):
-                        assert l.shape[1] == 5, 'labels require 5 columns each'
-                        assert (l >= 0).all(), 'negative labels'
-                        assert (l[:, 1:] <= 1).all(), 'non-normalized or out of bounds coordinate labels'
-                        assert np.unique(l, axis=0).shape[0] == l.shape[0], 'duplicate labels'
-                    else:
-                        ne += 1  # label empty
-                        l = np.zeros((0, 5), dtype=np.float32)
-                else:
-                    nm += 1  # label missing
-                    l = np.zeros((0, 5), dtype=np.float32)
-                x[im_file] = [l, shape, segments]
+                save_label_cache(path, entries, version)  # save for next time
+                logging.info(f'{prefix}New cache created: {path}')
             except Exception as e:
-                nc += 1
-                print(f'{prefix}WARNING: Ignoring corrupted image and/or label {im_file}: {e}')
-
-            pbar.desc = f"{prefix}Scanning '{path.parent / path.stem}' images and labels... " \
-                        f"{nf} found, {nm} missing, {ne} empty, {nc} corrupted"
-        pbar.close()
+                logging.info(f'{prefix}WARNING: Cache directory {path.parent} is not writeable: {e}')  # not writeable
 
+        status = np.bincount([e[3] for e in entries.values()], minlength=4)  # found, empty, missing, corrupted
+        nf, ne, nm, nc = status[0] + status[1], status[1], status[2], status[3]
         if nf == 0:
             print(f'{prefix}WARNING: No labels found in {path}. See {help_url}')
-
-        x['hash'] = get_hash(self.label_files + self.img_files)
-        x['results'] = nf, nm, ne, nc, i + 1
-        x['version'] = 0.1  # cache version
-        torch.save(x, path)  # save for next time
-        logging.info(f'{prefix}New cache created: {path}')
-        return x
+        x = {k: [e[0], e[1], e[2]] for k, e in entries.items() if e[3] != 3}  # corrupted pairs are ignored
+        x['results'] = nf, nm, ne, nc, len(entries)
+        return x, current
 
     def __len__(self):
         return len(self.img_files)
@@ -532,20 +875,24 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
     #     return self
 
     def __getitem__(self, index):
+        shape = None
+        if isinstance(index, tuple):  # (index, letterbox shape) from AspectRatioBatchSampler
+            index, shape = index
         index = self.indices[index]  # linear, shuffled, or image_weights
 
         hyp = self.hyp
         mosaic = self.mosaic and random.random() < hyp['mosaic']
+        batch_augment = self.batch_augment
         if mosaic:
             # Load mosaic
             if random.random() < 0.8:
-                img, labels = load_mosaic(self, index)
+                img, labels = load_mosaic(self, index, warp=not batch_augment)
             else:
-                img, labels = load_mosaic9(self, index)
+                img, labels = load_mosaic9(self, index, warp=not batch_augment)
             shapes = None
 
             # MixUp https://arxiv.org/pdf/1710.09412.pdf
-            if random.random() < hyp['mixup']:
+            if not batch_augment and random.random() < hyp['mixup']:
                 if random.random() < 0.8:
                     img2, labels2 = load_mosaic(self, random.randint(0, len(self.labels) - 1))
                 else:
@@ -559,7 +906,8 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             img, (h0, w0), (h, w) = load_image(self, index)
 
             # Letterbox
-            shape = self.batch_shapes[self.batch[index]] if self.rect else self.img_size  # final letterboxed shape
+            if shape is None:
+                shape = self.batch_shapes[self.batch[index]] if self.rect else self.img_size  # final letterboxed shape
             img, ratio, pad = letterbox(img, shape, auto=False, scaleup=self.augment)
             shapes = (h0, w0), ((h / h0, w / w0), pad)  # for COCO mAP rescaling
 
@@ -567,9 +915,16 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             if labels.size:  # normalized xywh to pixel xyxy format
                 labels[:, 1:] = xywhn2xyxy(labels[:, 1:], ratio[0] * w, ratio[1] * h, padw=pad[0], padh=pad[1])
 
+            if batch_augment:  # center on a mosaic canvas, BatchAugment warps both alike
+                s = self.img_size
+                canvas = mosaic_canvas(self, (s * 2, s * 2, 3))
+                canvas[s // 2:s // 2 + s, s // 2:s // 2 + s] = img
+                img = canvas
+                labels[:, 1:] += s // 2
+
         if self.augment:
             # Augment imagespace
-            if not mosaic:
+            if not mosaic and not batch_augment:
                 img, labels = random_perspective(img, labels,
                                                  degrees=hyp['degrees'],
                                                  translate=hyp['translate'],
@@ -581,23 +936,27 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             #img, labels = self.albumentations(img, labels)
 
             # Augment colorspace
-            augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
+            if not batch_augment:
+                augment_hsv(img, hgain=hyp['hsv_h'], sgain=hyp['hsv_s'], vgain=hyp['hsv_v'])
 
             # Apply cutouts
             # if random.random() < 0.9:
             #     labels = cutout(img, labels)
             
             if random.random() < hyp['paste_in']:
-                sample_labels, sample_images, sample_masks = [], [], [] 
-                while len(sample_labels) < 30:
-                    sample_labels_, sample_images_, sample_masks_ = load_samples(self, random.randint(0, len(self.labels) - 1))
-                    sample_labels += sample_labels_
-                    sample_images += sample_images_
-                    sample_masks += sample_masks_
-                    #print(len(sample_labels))
-                    if len(sample_labels) == 0:
-                        break
-                labels = pastein(img, labels, sample_labels, sample_images, sample_masks)
+                if self.patches is not None:  # precomputed PatchBank
+                    labels = pastein(img, labels, self.patches)
+                else:
+                    sample_labels, sample_images, sample_masks = [], [], []
+                    while len(sample_labels) < 30:
+                        sample_labels_, sample_images_, sample_masks_ = load_samples(self, random.randint(0, len(self.labels) - 1))
+                        sample_labels += sample_labels_
+                        sample_images += sample_images_
+                        sample_masks += sample_masks_
+                        #print(len(sample_labels))
+                        if len(sample_labels) == 0:
+                            break
+                    labels = pastein(img, labels, list(zip(sample_labels, sample_images, sample_masks)))
 
         nL = len(labels)  # number of labels
         if nL:
@@ -605,7 +964,7 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
             labels[:, [2, 4]] /= img.shape[0]  # normalized height 0-1
             labels[:, [1, 3]] /= img.shape[1]  # normalized width 0-1
 
-        if self.augment:
+        if self.augment and not batch_augment:
             # flip up-down
             if random.random() < hyp['flipud']:
                 img = np.flipud(img)
@@ -662,16 +1021,152 @@ class LoadImagesAndLabels(Dataset):  # for training/testing
         return torch.stack(img4, 0), torch.cat(label4, 0), path4, shapes4
 
 
+class ShardBuffer(LoadImagesAndLabels):
+    # Window of decoded samples streamed from shards, augmented by LoadImagesAndLabels.__getitem__() with mosaic tiles,
+    # MixUp and paste-in samples drawn from the window
+    def __init__(self, img_size=640, augment=False, hyp=None, batch_augment=False):
+        self.img_size, self.augment, self.hyp = img_size, augment, hyp
+        self.image_weights, self.rect, self.mosaic = False, False, augment
+        self.batch_augment = batch_augment and augment
+        self.mosaic_border = [-img_size // 2, -img_size // 2]
+        self.canvas, self.store, self.patches = {}, None, None
+        self.imgs, self.img_hw0, self.img_hw, self.labels, self.segments, self.img_files = [], [], [], [], [], []
+
+    @property
+    def indices(self):
+        return range(len(self.imgs))
+
+    def put(self, sample, i=None):
+        # Append sample (img, hw0, hw, labels, segments, file), or replace slot i
+        for x, v in zip((self.imgs, self.img_hw0, self.img_hw, self.labels, self.segments, self.img_files), sample):
+            if i is None:
+                x.append(v)
+            else:
+                x[i] = v
+
+
+class LoadShards(IterableDataset):  # for training/testing from make_shards() tar shards
+    def __init__(self, path, img_size=640, augment=False, hyp=None, single_cls=False, buffer=256, rank=-1, world_size=1,
+                 seed=0, prefix='', batch_augment=False, batch_size=1):
+        self.path, self.img_size, self.augment, self.hyp = Path(path), img_size, augment, hyp
+        self.batch_size = batch_size  # testing splits samples between workers in whole batches
+        self.single_cls, self.batch_augment = single_cls, batch_augment and augment
+        self.buffer = buffer  # shuffle buffer, decoded images per worker
+        self.rank, self.world_size = max(rank, 0), world_size if rank != -1 else 1
+        self.seed, self.epoch, self.stream = seed, 0, None  # epoch counted per worker, see __iter__()
+
+        x = np.load(self.path / 'shards.npz')
+        self.shards = [str(self.path / f) for f in x['shards']]
+        self.counts = x['counts']  # samples per shard
+        self.shapes = x['shapes']  # wh
+        self.labels = Ragged(data=x['labels'].copy(), offsets=x['offsets'])
+        if single_cls:
+            self.labels.data[:, 0] = 0
+        self.n = len(self.shapes)
+        assert self.n, f'{prefix}No samples in {path}'
+        logging.info(f'{prefix}{path}: {self.n} samples in {len(self.shards)} shards')
+
+    def __len__(self):
+        return math.ceil(self.n / self.world_size)  # samples per rank
+
+    def __iter__(self):
+        # Shards go round robin to (rank, worker). Training draws len(self) / workers samples per epoch from an endless
+        # shuffle buffer that persists across epochs, so ranks stay in step and every sample leaves the buffer once per
+        # pass. Testing gives each (rank, worker) a contiguous run of whole batches, so every sample is read once
+        info = torch.utils.data.get_worker_info()
+        w, nw = (info.id, info.num_workers) if info else (0, 1)
+        k, j = self.world_size * nw, self.rank * nw + w
+        if not self.augment:
+            nb = math.ceil(self.n / self.batch_size)  # batches
+            buf = ShardBuffer(self.img_size, False, self.hyp)
+            for x in self.span(self.batch_size * (nb * j // k), min(self.batch_size * (nb * (j + 1) // k), self.n)):
+                buf.put(x, 0 if buf.imgs else None)
+                yield buf[0]
+            return
+
+        order = random.Random(self.seed).sample(self.shards, len(self.shards))
+        mine = order[j::k] or [order[j % len(order)]]  # fewer shards than workers repeat some shards
+
+        self.epoch += 1  # every worker iterates once per epoch, no set_epoch() needed
+        if getattr(self, 'stream', None) is None:  # per worker, persistent_workers keeps it between epochs
+            self.stream = self.samples(mine, j=j), ShardBuffer(self.img_size, self.augment, self.hyp, self.batch_augment)
+        samples, buf = self.stream
+        count = dict(zip(self.shards, self.counts))
+        while len(buf.imgs) < min(self.buffer, sum(count[x] for x in mine)):  # each sample in the buffer at most once
+            buf.put(next(samples))
+        for _ in range(len(self) // nw + (w < len(self) % nw)):
+            i = random.randrange(len(buf.imgs))
+            yield buf[i]
+            buf.put(next(samples), i)
+
+    def samples(self, shards, passes=None, j=0):
+        # Sequential read of shards, one (img, hw0, hw, labels, segments, file) per tar key. Training reshuffles the
+        # shards of worker j every pass, seeded by (seed, epoch, worker, pass) so runs are reproducible
+        p = 0
+        while passes is None or p < passes:
+            if self.augment:
+                shards = random.Random(f'{self.seed} {self.epoch} {j} {p}').sample(shards, len(shards))
+            p += 1
+            for shard in shards:
+                for item in self.items(shard):
+                    yield self.decode(item, shard)
+
+    def span(self, start, end):
+        # Samples start to end - 1 in shard order, reading only the shards that hold them
+        i = 0
+        for shard, n in zip(self.shards, self.counts.tolist()):
+            if i < end and i + n > start:
+                for item in islice(self.items(shard), max(start - i, 0), end - i):
+                    yield self.decode(item, shard)
+            i += n
+
+    @staticmethod
+    def items(shard):
+        # Raw {ext: bytes} per tar key, sequential read
+        with tarfile.open(shard, 'r|*') as tar:  # stream, no seeks
+            key, item = None, {}
+            for m in tar:
+                k, ext = m.name.rsplit('.', 1)
+                if k != key and item:
+                    yield item
+                    item = {}
+                key, item[ext.lower()] = k, tar.extractfile(m).read()
+            if item:
+                yield item
+
+    def decode(self, item, shard):
+        img = next(v for k, v in item.items() if k in img_formats)
+        img = cv2.imdecode(np.frombuffer(img, np.uint8), cv2.IMREAD_COLOR)  # BGR
+        h0, w0 = img.shape[:2]  # orig hw
+        r = self.img_size / max(h0, w0)  # resize image to img_size
+        if r != 1:  # always resize down, only resize up if training with augmentation
+            interp = cv2.INTER_AREA if r < 1 and not self.augment else cv2.INTER_LINEAR
+            img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=interp)
+        labels, segments = parse_labels(item.get('txt', b'').decode())
+        labels = labels.reshape(-1, 5)
+        if self.single_cls:
+            labels[:, 0] = 0
+        return img, (h0, w0), img.shape[:2], labels, segments, item['file'].decode() if 'file' in item else shard
+
+
 # Ancillary functions --------------------------------------------------------------------------------------------------
-def load_image(self, index):
-    # loads 1 image from dataset, returns img, original hw, resized hw
+def load_image(self, index, resize=True):
+    # loads 1 image from dataset, returns img, original hw, resized hw. resize=False skips the resize of uncached images
     img = self.imgs[index]
+    if img is None and getattr(self, 'store', None) is not None:  # memory-mapped, zero-copy
+        return self.store.get(index)
     if img is None:  # not cached
         path = self.img_files[index]
-        img = cv2.imread(path)  # BGR
-        assert img is not None, 'Image Not Found ' + path
-        h0, w0 = img.shape[:2]  # orig hw
+        if getattr(self, 'reduced_decode', False):  # JPEG decoded at 1/2, 1/4 or 1/8 scale when large enough
+            w0, h0 = self.shapes[index].astype(int)  # orig hw from the label cache
+            img = imread_reduced(path, (h0, w0), self.img_size)
+        if img is None:
+            img = cv2.imread(path)  # BGR
+            assert img is not None, 'Image Not Found ' + path
+            h0, w0 = img.shape[:2]  # orig hw
         r = self.img_size / max(h0, w0)  # resize image to img_size
+        if not resize:  # caller resizes, see place_tile()
+            return img, (h0, w0), (int(h0 * r), int(w0 * r))
         if r != 1:  # always resize down, only resize up if training with augmentation
             interp = cv2.INTER_AREA if r < 1 and not self.augment else cv2.INTER_LINEAR
             img = cv2.resize(img, (int(w0 * r), int(h0 * r)), interpolation=interp)
@@ -680,6 +1175,19 @@ def load_image(self, index):
         return self.imgs[index], self.img_hw0[index], self.img_hw[index]  # img, hw_original, hw_resized
 
 
+def imread_reduced(path, hw0, size):
+    # Reduced-resolution JPEG decode (libjpeg DCT scaling) to the smallest 1/8, 1/4 or 1/2 scale that still has at
+    # least size pixels on the long side. Returns None when no scale fits or the decoded shape is not the expected one
+    if path.rsplit('.', 1)[-1].lower() not in ('jpg', 'jpeg'):
+        return None
+    h0, w0 = hw0
+    for f, flag in (8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2):
+        if max(h0, w0) / f >= size:
+            img = cv2.imread(path, flag)  # BGR
+            return img if img is not None and img.shape[:2] == (math.ceil(h0 / f), math.ceil(w0 / f)) else None
+    return None
+
+
 def augment_hsv(img, hgain=0.5, sgain=0.5, vgain=0.5):
     r = np.random.uniform(-1, 1, 3) * [hgain, sgain, vgain] + 1  # random gains
     hue, sat, val = cv2.split(cv2.cvtColor(img, cv2.COLOR_BGR2HSV))
@@ -705,20 +1213,46 @@ def hist_equalize(img, clahe=True, bgr=False):
     return cv2.cvtColor(yuv, cv2.COLOR_YUV2BGR if bgr else cv2.COLOR_YUV2RGB)  # convert YUV image to RGB
 
 
-def load_mosaic(self, index):
-    # loads images in a 4-mosaic
+def mosaic_canvas(self, shape):
+    # Gray canvas reused across samples instead of a fresh np.full() per mosaic
+    img = self.canvas.get(shape)
+    if img is None:
+        img = self.canvas[shape] = np.empty(shape, dtype=np.uint8)
+    img.fill(114)
+    return img
+
+
+def place_tile(img, hw, dst, x, y):
+    # Write the (x, y) origin region of img resized to hw into dst. Unresized images are resized straight into place when
+    # fully visible, mostly clipped ones resample only the visible region with the pixel centers of cv2.resize()
+    h, w = dst.shape[:2]
+    if img.shape[:2] == tuple(hw):
+        dst[:] = img[y:y + h, x:x + w]
+    elif (h, w) == tuple(hw):
+        cv2.resize(img, (w, h), dst=dst, interpolation=cv2.INTER_LINEAR)
+    elif h * w * 3 > hw[0] * hw[1]:  # warpAffine costs ~3x cv2.resize per pixel
+        dst[:] = cv2.resize(img, hw[::-1], interpolation=cv2.INTER_LINEAR)[y:y + h, x:x + w]
+    elif h and w:
+        fy, fx = img.shape[0] / hw[0], img.shape[1] / hw[1]
+        M = np.array([[fx, 0, (x + 0.5) * fx - 0.5], [0, fy, (y + 0.5) * fy - 0.5]])
+        cv2.warpAffine(img, M, (w, h), dst=dst, flags=cv2.INTER_LINEAR | cv2.WARP_INVERSE_MAP,
+                       borderMode=cv2.BORDER_REPLICATE)
+
+
+def load_mosaic(self, index, warp=True):
+    # loads images in a 4-mosaic, warp=False returns the 2s x 2s canvas itself (valid until the next mosaic)
 
     labels4, segments4 = [], []
     s = self.img_size
     yc, xc = [int(random.uniform(-x, 2 * s + x)) for x in self.mosaic_border]  # mosaic center x, y
     indices = [index] + random.choices(self.indices, k=3)  # 3 additional image indices
+    img4 = mosaic_canvas(self, (s * 2, s * 2, 3))  # base image with 4 tiles
     for i, index in enumerate(indices):
         # Load image
-        img, _, (h, w) = load_image(self, index)
+        img, _, (h, w) = load_image(self, index, resize=False)
 
         # place img in img4
         if i == 0:  # top left
-            img4 = np.full((s * 2, s * 2, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
             x1a, y1a, x2a, y2a = max(xc - w, 0), max(yc - h, 0), xc, yc  # xmin, ymin, xmax, ymax (large image)
             x1b, y1b, x2b, y2b = w - (x2a - x1a), h - (y2a - y1a), w, h  # xmin, ymin, xmax, ymax (small image)
         elif i == 1:  # top right
@@ -731,7 +1265,7 @@ def load_mosaic(self, index):
             x1a, y1a, x2a, y2a = xc, yc, min(xc + w, s * 2), min(s * 2, yc + h)
             x1b, y1b, x2b, y2b = 0, 0, min(w, x2a - x1a), min(y2a - y1a, h)
 
-        img4[y1a:y2a, x1a:x2a] = img[y1b:y2b, x1b:x2b]  # img4[ymin:ymax, xmin:xmax]
+        place_tile(img, (h, w), img4[y1a:y2a, x1a:x2a], x1b, y1b)  # img4[ymin:ymax, xmin:xmax]
         padw = x1a - x1b
         padh = y1a - y1b
 
@@ -752,7 +1286,10 @@ def load_mosaic(self, index):
     # Augment
     #img4, labels4, segments4 = remove_background(img4, labels4, segments4)
     #sample_segments(img4, labels4, segments4, probability=self.hyp['copy_paste'])
+    canvas = img4
     img4, labels4, segments4 = copy_paste(img4, labels4, segments4, probability=self.hyp['copy_paste'])
+    if not warp:
+        return img4, labels4
     img4, labels4 = random_perspective(img4, labels4, segments4,
                                        degrees=self.hyp['degrees'],
                                        translate=self.hyp['translate'],
@@ -761,22 +1298,23 @@ def load_mosaic(self, index):
                                        perspective=self.hyp['perspective'],
                                        border=self.mosaic_border)  # border to remove
 
-    return img4, labels4
+    return img4.copy() if img4 is canvas else img4, labels4
 
 
-def load_mosaic9(self, index):
-    # loads images in a 9-mosaic
+def load_mosaic9(self, index, warp=True):
+    # loads images in a 9-mosaic, tiles are placed straight into the 2s x 2s crop of the 3s x 3s layout
 
     labels9, segments9 = [], []
     s = self.img_size
     indices = [index] + random.choices(self.indices, k=8)  # 8 additional image indices
+    yc, xc = [int(random.uniform(0, s)) for _ in self.mosaic_border]  # mosaic center x, y
+    img9 = mosaic_canvas(self, (s * 2, s * 2, 3))  # img9[yc:yc + 2 * s, xc:xc + 2 * s] of the 9-tile layout
     for i, index in enumerate(indices):
         # Load image
-        img, _, (h, w) = load_image(self, index)
+        img, _, (h, w) = load_image(self, index, resize=False)
 
         # place img in img9
         if i == 0:  # center
-            img9 = np.full((s * 3, s * 3, img.shape[2]), 114, dtype=np.uint8)  # base image with 4 tiles
             h0, w0 = h, w
             c = s, s, s + w, s + h  # xmin, ymin, xmax, ymax (base) coordinates
         elif i == 1:  # top
@@ -796,8 +1334,9 @@ def load_mosaic9(self, index):
         elif i == 8:  # top left
             c = s - w, s + h0 - hp - h, s, s + h0 - hp
 
-        padx, pady = c[:2]
-        x1, y1, x2, y2 = [max(x, 0) for x in c]  # allocate coords
+        padx, pady = c[0] - xc, c[1] - yc  # tile origin in crop coordinates
+        x1, y1 = max(padx, 0), max(pady, 0)
+        x2, y2 = min(max(c[2] - xc, x1), 2 * s), min(max(c[3] - yc, y1), 2 * s)  # allocate coords
 
         # Labels
         labels, segments = self.labels[index].copy(), self.segments[index].copy()
@@ -808,27 +1347,21 @@ def load_mosaic9(self, index):
         segments9.extend(segments)
 
         # Image
-        img9[y1:y2, x1:x2] = img[y1 - pady:, x1 - padx:]  # img9[ymin:ymax, xmin:xmax]
+        place_tile(img, (h, w), img9[y1:y2, x1:x2], x1 - padx, y1 - pady)  # img9[ymin:ymax, xmin:xmax]
         hp, wp = h, w  # height, width previous
 
-    # Offset
-    yc, xc = [int(random.uniform(0, s)) for _ in self.mosaic_border]  # mosaic center x, y
-    img9 = img9[yc:yc + 2 * s, xc:xc + 2 * s]
-
     # Concat/clip labels
     labels9 = np.concatenate(labels9, 0)
-    labels9[:, [1, 3]] -= xc
-    labels9[:, [2, 4]] -= yc
-    c = np.array([xc, yc])  # centers
-    segments9 = [x - c for x in segments9]
-
     for x in (labels9[:, 1:], *segments9):
         np.clip(x, 0, 2 * s, out=x)  # clip when using random_perspective()
     # img9, labels9 = replicate(img9, labels9)  # replicate
 
     # Augment
     #img9, labels9, segments9 = remove_background(img9, labels9, segments9)
+    canvas = img9
     img9, labels9, segments9 = copy_paste(img9, labels9, segments9, probability=self.hyp['copy_paste'])
+    if not warp:
+        return img9, labels9
     img9, labels9 = random_perspective(img9, labels9, segments9,
                                        degrees=self.hyp['degrees'],
                                        translate=self.hyp['translate'],
@@ -837,7 +1370,7 @@ def load_mosaic9(self, index):
                                        perspective=self.hyp['perspective'],
                                        border=self.mosaic_border)  # border to remove
 
-    return img9, labels9
+    return img9.copy() if img9 is canvas else img9, labels9
 
 
 def load_samples(self, index):
@@ -891,6 +1424,25 @@ def load_samples(self, index):
     return sample_labels, sample_images, sample_masks
 
 
+def cut_patches(self, index):
+    # Patches of all segments of one image at img_size: (cls, BGR + mask channel), cf. sample_segments()
+    segments = self.segments[index]
+    if not len(segments):
+        return []
+    img, _, (h, w) = load_image(self, index)
+    patches = []
+    for c, x in zip(self.labels[index][:, 0], segments):
+        xy = xyn2xy(x, w, h)
+        x1, y1 = xy.min(0).astype(int).clip(0, (w - 1, h - 1))
+        x2, y2 = xy.max(0).astype(int).clip(0, (w - 1, h - 1))
+        if x2 <= x1 or y2 <= y1:
+            continue
+        mask = np.zeros((y2 - y1, x2 - x1), dtype=np.uint8)
+        cv2.drawContours(mask, [(xy - (x1, y1)).astype(np.int32)], -1, 255, cv2.FILLED)
+        patches.append((int(c), np.dstack((img[y1:y2, x1:x2] * (mask[..., None] > 0), mask))))
+    return patches
+
+
 def copy_paste(img, labels, segments, probability=0.5):
     # Implement Copy-Paste augmentation https://arxiv.org/abs/2012.07177, labels as nx5 np.array(cls, xyxy)
     n = len(segments)
@@ -1014,6 +1566,27 @@ def letterbox(img, new_shape=(640, 640), color=(114, 114, 114), auto=True, scale
     return img, ratio, (dw, dh)
 
 
+def tile_image(img, tile=640, overlap=0.2, stride=32, y_max=None, color=(114, 114, 114)):
+    # Cut img(h,w,3) BGR into overlapping stride-aligned tiles, optionally only rows above y_max
+    # Returns tiles(n,3,tile,tile) RGB uint8 and their (x, y) top-left offsets(n,2) in img pixels
+    tile = math.ceil(tile / stride) * stride
+    h, w = img.shape[:2]
+    h = min(h, int(y_max)) if y_max else h
+    step = max(int(tile * (1 - overlap)) // stride * stride, stride)
+
+    def starts(n):  # tile starts covering [0, n), the last tile flush with the edge
+        s = list(range(0, max(n - tile, 0) + 1, step))
+        return s + [n - tile] if s[-1] + tile < n else s
+
+    offsets = np.array([(x, y) for y in starts(h) for x in starts(w)])
+    tiles = np.full((len(offsets), tile, tile, 3), color, dtype=np.uint8)  # pad tiles larger than the image
+    for t, (x, y) in zip(tiles, offsets):
+        crop = img[y:min(y + tile, h), x:x + tile]
+        t[:crop.shape[0], :crop.shape[1]] = crop
+    tiles = np.ascontiguousarray(tiles[..., ::-1].transpose(0, 3, 1, 2))  # BGR to RGB, to bsx3xtilextile
+    return tiles, offsets
+
+
 def random_perspective(img, targets=(), segments=(), degrees=10, translate=.1, scale=.1, shear=10, perspective=0.0,
                        border=(0, 0)):
     # torchvision.transforms.RandomAffine(degrees=(-10, 10), translate=(.1, .1), scale=(.9, 1.1), shear=(-10, 10))
@@ -1111,9 +1684,116 @@ def box_candidates(box1, box2, wh_thr=2, ar_thr=20, area_thr=0.1, eps=1e-16):  #
     return (w2 > wh_thr) & (h2 > wh_thr) & (w2 * h2 / (w1 * h1 + eps) > area_thr) & (ar < ar_thr)  # candidates
 
 
+class BatchAugment:
+    # Image space augmentation of a collated batch on the training device, the batched counterpart of random_perspective,
+    # MixUp, augment_hsv and flips in LoadImagesAndLabels.__getitem__(). Takes the 2s x 2s canvases returned with
+    # batch_augment=True as RGB 0-1 floats and targets(n,6) [image, class, xywh normalized], returns s x s images
+    def __init__(self, hyp):
+        self.hyp = hyp
+
+    def __call__(self, imgs, targets):
+        imgs, targets = self.perspective(imgs, targets)
+        imgs, targets = self.mixup(imgs, targets)
+        imgs = self.hsv(imgs)
+        return self.flip(imgs, targets)
+
+    def perspective(self, imgs, targets):
+        # random_perspective() with a mosaic border: one grid_sample for the batch, boxes warped by their image's M
+        hyp, (bs, _, h, w), device = self.hyp, imgs.shape, imgs.device
+        height, width = h // 2, w // 2  # border = -s // 2
+        u = lambda x: torch.empty(bs, dtype=torch.float64).uniform_(-x, x)
+        eye = torch.eye(3, dtype=torch.float64).repeat(bs, 1, 1)
+        C, P, R, S, T = eye.clone(), eye.clone(), eye.clone(), eye.clone(), eye.clone()
+        C[:, 0, 2], C[:, 1, 2] = -w / 2, -h / 2  # center
+        P[:, 2, 0], P[:, 2, 1] = u(hyp['perspective']), u(hyp['perspective'])  # perspective
+        a, s = u(hyp['degrees']) * math.pi / 180, torch.empty(bs, dtype=torch.float64).uniform_(1 - hyp['scale'],
+                                                                                                1.1 + hyp['scale'])
+        R[:, 0, 0], R[:, 0, 1], R[:, 1, 0], R[:, 1, 1] = s * a.cos(), s * a.sin(), -s * a.sin(), s * a.cos()  # rotation
+        S[:, 0, 1], S[:, 1, 0] = (u(hyp['shear']) * math.pi / 180).tan(), (u(hyp['shear']) * math.pi / 180).tan()
+        T[:, 0, 2] = (u(hyp['translate']) + 0.5) * width  # x translation (pixels)
+        T[:, 1, 2] = (u(hyp['translate']) + 0.5) * height  # y translation (pixels)
+        M = (T @ S @ R @ P @ C).float().to(device)  # order of operations (right to left) is IMPORTANT
+
+        # Image, output pixel centers mapped back to the input, gray (114) outside it
+        y, x = torch.meshgrid(torch.arange(height, device=device), torch.arange(width, device=device), indexing='ij')
+        xy = torch.stack((x, y, torch.ones_like(x)), -1).view(1, -1, 3).float() @ M.inverse().transpose(1, 2)
+        grid = (2 * xy[..., :2] / xy[..., 2:] + 1) / torch.tensor([w, h], device=device) - 1
+        imgs = F.grid_sample(imgs - 114 / 255, grid.view(bs, height, width, 2), align_corners=False) + 114 / 255
+
+        # Labels
+        if len(targets):
+            i = targets[:, 0].long()
+            box = xywh2xyxy(targets[:, 2:]) * torch.tensor([w, h, w, h], device=device)
+            xy = torch.ones(len(box), 4, 3, device=device)
+            xy[..., :2] = box[:, [0, 1, 2, 3, 0, 3, 2, 1]].view(-1, 4, 2)  # x1y1, x2y2, x1y2, x2y1
+            xy = xy @ M[i].transpose(1, 2)  # transform
+            xy = xy[..., :2] / xy[..., 2:]  # perspective rescale or affine
+            new = torch.cat((xy.min(1)[0], xy.max(1)[0]), 1)
+            new[:, [0, 2]] = new[:, [0, 2]].clamp(0, width)
+            new[:, [1, 3]] = new[:, [1, 3]].clamp(0, height)
+
+            # filter candidates, see box_candidates()
+            w1, h1 = (box[:, 2:] - box[:, :2]).T * s.float().to(device)[i]
+            w2, h2 = (new[:, 2:] - new[:, :2]).T
+            ar = torch.maximum(w2 / (h2 + 1e-16), h2 / (w2 + 1e-16))  # aspect ratio
+            k = (w2 > 2) & (h2 > 2) & (w2 * h2 / (w1 * h1 + 1e-16) > 0.1) & (ar < 20)
+            targets = targets[k]
+            targets[:, 2:] = xyxy2xywh(new[k]) / torch.tensor([width, height, width, height], device=device)
+        return imgs, targets
+
+    def mixup(self, imgs, targets):
+        # MixUp https://arxiv.org/pdf/1710.09412.pdf, image i mixed with image i - 1 and given its labels
+        bs, device = imgs.shape[0], imgs.device
+        m = torch.rand(bs) < self.hyp['mixup']
+        if bs < 2 or not m.any():
+            return imgs, targets
+        i = m.nonzero()[:, 0]
+        r = torch.distributions.Beta(8.0, 8.0).sample((len(i), 1, 1, 1)).to(device)  # mixup ratio, alpha=beta=8.0
+        imgs[i.to(device)] = imgs[i.to(device)] * r + imgs[((i - 1) % bs).to(device)] * (1 - r)
+        t = targets[m.to(device)[(targets[:, 0].long() + 1) % bs]].clone()
+        t[:, 0] = (t[:, 0] + 1) % bs
+        return imgs, torch.cat((targets, t), 0)
+
+    def hsv(self, imgs):
+        # augment_hsv() on RGB floats, hue gain wraps and saturation/value gains clip like its lookup tables
+        hyp, bs = self.hyp, imgs.shape[0]
+        gain = torch.tensor([hyp['hsv_h'], hyp['hsv_s'], hyp['hsv_v']])
+        if not gain.any():
+            return imgs
+        g = ((torch.rand(bs, 3) * 2 - 1) * gain + 1).to(imgs.device).view(bs, 3, 1, 1)  # random gains
+
+        r, gr, b = imgs.unbind(1)
+        v, _ = imgs.max(1)
+        d = v - imgs.min(1)[0]
+        sat = d / v.clamp(min=1e-8)
+        dc = d.clamp(min=1e-8)
+        hue = torch.where(v == r, (gr - b) / dc, torch.where(v == gr, 2 + (b - r) / dc, 4 + (r - gr) / dc))
+        hue = (hue / 6) % 1  # to [0, 1) before the gain, the red/magenta sector is negative here
+        hue = (hue * g[:, 0]) % 1
+        sat = (sat * g[:, 1]).clamp(0, 1)
+        v = (v * g[:, 2]).clamp(0, 1)
+
+        k = (torch.tensor([5, 3, 1], device=imgs.device).view(1, 3, 1, 1) + hue.unsqueeze(1) * 6) % 6
+        return v.unsqueeze(1) * (1 - sat.unsqueeze(1) * torch.minimum(k, 4 - k).clamp(0, 1))
+
+    def flip(self, imgs, targets):
+        # flip up-down and left-right per image
+        bs, device = imgs.shape[0], imgs.device
+        for dim, p, j in (2, self.hyp['flipud'], 3), (3, self.hyp['fliplr'], 2):
+            m = (torch.rand(bs) < p).to(device)
+            if m.any():
+                imgs[m] = imgs[m].flip(dim)
+                k = m[targets[:, 0].long()]
+                targets[k, j] = 1 - targets[k, j]
+        return imgs, targets
+
+
 def bbox_ioa(box1, box2):
-    # Returns the intersection over box2 area given box1, box2. box1 is 4, box2 is nx4. boxes are x1y1x2y2
+    # Returns the intersection over box2 area given box1, box2. box1 is 4 or mx4, box2 is nx4 (result n or mxn).
+    # boxes are x1y1x2y2
     box2 = box2.transpose()
+    if np.ndim(box1) == 2:
+        box1 = np.asarray(box1).transpose()[..., None]
 
     # Get the coordinates of bounding boxes
     b1_x1, b1_y1, b1_x2, b1_y2 = box1[0], box1[1], box1[2], box1[3]
@@ -1158,61 +1838,41 @@ def cutout(image, labels):
     return labels
     
 
-def pastein(image, labels, sample_labels, sample_images, sample_masks):
-    # Applies image cutout augmentation https://arxiv.org/abs/1708.04552
+def pastein(image, labels, patches):
+    # Paste random (cls, img, mask) patches into random boxes that cover < 30% of any label, labels as nx5 (cls, xyxy)
     h, w = image.shape[:2]
-
-    # create random masks
-    scales = [0.75] * 2 + [0.5] * 4 + [0.25] * 4 + [0.125] * 4 + [0.0625] * 6  # image size fraction
-    for s in scales:
-        if random.random() < 0.2:
-            continue
-        mask_h = random.randint(1, int(h * s))
-        mask_w = random.randint(1, int(w * s))
-
-        # box
-        xmin = max(0, random.randint(0, w) - mask_w // 2)
-        ymin = max(0, random.randint(0, h) - mask_h // 2)
-        xmax = min(w, xmin + mask_w)
-        ymax = min(h, ymin + mask_h)   
-        
-        box = np.array([xmin, ymin, xmax, ymax], dtype=np.float32)
-        if len(labels):
-            ioa = bbox_ioa(box, labels[:, 1:5])  # intersection over area     
-        else:
-            ioa = np.zeros(1)
-        
-        if (ioa < 0.30).all() and len(sample_labels) and (xmax > xmin+20) and (ymax > ymin+20):  # allow 30% obscuration of existing labels
-            sel_ind = random.randint(0, len(sample_labels)-1)
-            #print(len(sample_labels))
-            #print(sel_ind)
-            #print((xmax-xmin, ymax-ymin))
-            #print(image[ymin:ymax, xmin:xmax].shape)
-            #print([[sample_labels[sel_ind], *box]])
-            #print(labels.shape)
-            hs, ws, cs = sample_images[sel_ind].shape
-            r_scale = min((ymax-ymin)/hs, (xmax-xmin)/ws)
-            r_w = int(ws*r_scale)
-            r_h = int(hs*r_scale)
-            
-            if (r_w > 10) and (r_h > 10):
-                r_mask = cv2.resize(sample_masks[sel_ind], (r_w, r_h))
-                r_image = cv2.resize(sample_images[sel_ind], (r_w, r_h))
-                temp_crop = image[ymin:ymin+r_h, xmin:xmin+r_w]
-                m_ind = r_mask > 0
-                if m_ind.astype(np.int).sum() > 60:
-                    temp_crop[m_ind] = r_image[m_ind]
-                    #print(sample_labels[sel_ind])
-                    #print(sample_images[sel_ind].shape)
-                    #print(temp_crop.shape)
-                    box = np.array([xmin, ymin, xmin+r_w, ymin+r_h], dtype=np.float32)
-                    if len(labels):
-                        labels = np.concatenate((labels, [[sample_labels[sel_ind], *box]]), 0)
-                    else:
-                        labels = np.array([[sample_labels[sel_ind], *box]])
-                              
-                    image[ymin:ymin+r_h, xmin:xmin+r_w] = temp_crop
-
+    if not len(patches):
+        return labels
+
+    # random boxes, all at once
+    scales = np.array([0.75] * 2 + [0.5] * 4 + [0.25] * 4 + [0.125] * 4 + [0.0625] * 6)  # image size fraction
+    scales = scales[np.random.rand(len(scales)) >= 0.2]
+    mask_h = np.random.randint(1, (h * scales).astype(int) + 1)
+    mask_w = np.random.randint(1, (w * scales).astype(int) + 1)
+    xmin = np.maximum(0, np.random.randint(0, w + 1, len(scales)) - mask_w // 2)
+    ymin = np.maximum(0, np.random.randint(0, h + 1, len(scales)) - mask_h // 2)
+    boxes = np.stack((xmin, ymin, np.minimum(w, xmin + mask_w), np.minimum(h, ymin + mask_h)), 1)
+    ok = (boxes[:, 2] > boxes[:, 0] + 20) & (boxes[:, 3] > boxes[:, 1] + 20)
+    if len(labels):
+        ok &= (bbox_ioa(boxes, labels[:, 1:5]) < 0.30).all(1)  # allow 30% obscuration of existing labels
+
+    pasted = []
+    for xmin, ymin, xmax, ymax in boxes[ok]:
+        if pasted and (bbox_ioa(np.array([xmin, ymin, xmax, ymax]), np.array(pasted)[:, 1:]) >= 0.30).any():
+            continue  # obscures a patch pasted before
+        c, img, mask = patches[random.randint(0, len(patches) - 1)]
+        hs, ws = img.shape[:2]
+        r_scale = min((ymax - ymin) / hs, (xmax - xmin) / ws)
+        r_w, r_h = int(ws * r_scale), int(hs * r_scale)
+        if (r_w > 10) and (r_h > 10):
+            m_ind = cv2.resize(mask, (r_w, r_h)) > 0
+            if m_ind.sum() > 60:
+                image[ymin:ymin + r_h, xmin:xmin + r_w][m_ind] = cv2.resize(img, (r_w, r_h))[m_ind]
+                pasted.append([c, xmin, ymin, xmin + r_w, ymin + r_h])
+
+    if pasted:
+        pasted = np.array(pasted, dtype=np.float32)
+        labels = np.concatenate((labels, pasted), 0) if len(labels) else pasted
     return labels
 
 class Albumentations:
@@ -1283,7 +1943,7 @@ def extract_boxes(path='../coco/'):  # from utils.datasets import *; extract_box
                     b = x[1:] * [w, h, w, h]  # box
                     # b[2:] = b[2:].max()  # rectangle to square
                     b[2:] = b[2:] * 1.2 + 3  # pad
-                    b = xywh2xyxy(b.reshape(-1, 4)).ravel().astype(np.int)
+                    b = xywh2xyxy(b.reshape(-1, 4)).ravel().astype(int)
 
                     b[[0, 2]] = np.clip(b[[0, 2]], 0, w)  # clip boxes outside of image
                     b[[1, 3]] = np.clip(b[[1, 3]], 0, h)
@@ -1313,6 +1973,44 @@ def autosplit(path='../coco', weights=(0.9, 0.1, 0.0), annotated_only=False):
                 f.write(str(img) + '\n')  # add image to txt file
     
     
+def make_shards(path='../coco/images/train2017', out='', shard_size=1000, shuffle=True):
+    """ Pack an images/ labels/ dataset into sequentially readable tar shards for LoadShards
+    Usage: from utils.datasets import *; make_shards('../coco/images/train2017')
+    Arguments
+        path:           Images directory or *.txt list, as in data/*.yaml
+        out:            Output directory, default path + '_shards', use it in place of path in data/*.yaml
+        shard_size:     Samples per shard
+        shuffle:        Shuffle samples across shards once, LoadShards then only shuffles shards and a buffer
+    """
+    dataset = LoadImagesAndLabels(path)  # verified files, labels and shapes from the label cache
+    p = Path(path)
+    out = Path(out or p.parent / (p.stem + '_shards'))  # images/train2017 -> images/train2017_shards
+    out.mkdir(parents=True, exist_ok=True)
+    order = np.random.default_rng(0).permutation(dataset.n) if shuffle else np.arange(dataset.n)
+
+    shards, counts = [], []
+    for j in tqdm(range(0, len(order), shard_size), desc=f'Writing shards to {out}'):
+        shards.append(f'shard{len(shards):06d}.tar')
+        counts.append(len(order[j:j + shard_size]))
+        with tarfile.open(out / shards[-1], 'w') as tar:
+            for i in order[j:j + shard_size]:
+                im, lb = dataset.img_files[i], dataset.label_files[i]
+                key = f'{i:08d}'
+                tar.add(im, arcname=f'{key}.{im.rsplit(".", 1)[-1].lower()}')
+                if os.path.isfile(lb):
+                    tar.add(lb, arcname=f'{key}.txt')
+                b = im.encode()
+                info = tarfile.TarInfo(f'{key}.file')
+                info.size = len(b)
+                tar.addfile(info, io.BytesIO(b))  # source path, returned as the sample path
+
+    labels = dataset.labels.take(order)
+    np.savez(out / 'shards.npz', shards=np.array(shards), counts=np.array(counts), shapes=dataset.shapes[order],
+             labels=labels.data, offsets=labels.offsets)
+    print(f'{dataset.n} samples in {len(shards)} shards saved to {out}')
+    return out
+
+
 def load_segmentations(self, index):
     key = '/work/handsomejw66/coco17/' + self.img_files[index]
     #print(key)
@@ -15,9 +15,13 @@ import cv2
 import numpy as np
 import pandas as pd
 import torch
-import torchvision
 import yaml
 
+try:
+    import torchvision  # only for the 'torchvision' NMS engine here
+except ImportError:
+    torchvision = None
+
 from .google_utils import gsutil_getsize
 from .metrics import fitness
 from .torch_utils import init_torch_seeds
@@ -219,7 +223,7 @@ def labels_to_class_weights(labels, nc=80):
         return torch.Tensor()
 
     labels = np.concatenate(labels, 0)  # labels.shape = (866643, 5) for COCO
-    classes = labels[:, 0].astype(np.int)  # labels = [class xywh]
+    classes = labels[:, 0].astype(int)  # labels = [class xywh]
     weights = np.bincount(classes, minlength=nc)  # occurrences per class
 
     # Prepend gridpoint count (for uCE training)
@@ -234,7 +238,7 @@ def labels_to_class_weights(labels, nc=80):
 
 def labels_to_image_weights(labels, nc=80, class_weights=np.ones(80)):
     # Produces image weights based on class_weights and image contents
-    class_counts = np.array([np.bincount(x[:, 0].astype(np.int), minlength=nc) for x in labels])
+    class_counts = np.array([np.bincount(x[:, 0].astype(int), minlength=nc) for x in labels])
     image_weights = (class_weights.reshape(1, nc) * class_counts).sum(1)
     # index = random.choices(range(n), weights=image_weights, k=1)  # weight image sample
     return image_weights
@@ -604,8 +608,76 @@ def box_diou(box1, box2, eps: float = 1e-7):
     return iou - (centers_distance_squared / diagonal_distance_squared)
 
 
+def fast_nms(boxes, scores, iou_thres):
+    # Fast-NMS https://arxiv.org/abs/1904.02689, suppresses with the upper-triangular IoU matrix in one step.
+    # Already-suppressed boxes may still suppress others, so it keeps slightly fewer boxes than greedy NMS.
+    i = scores.argsort(descending=True)
+    if not len(i):
+        return i
+    iou = box_iou(boxes[i], boxes[i]).triu_(diagonal=1)  # iou with every higher-scoring box
+    return i[iou.max(0)[0] <= iou_thres]
+
+
+def cluster_nms(boxes, scores, iou_thres):
+    # Cluster-NMS https://arxiv.org/abs/2005.03572, iterates Fast-NMS in matrix form until it matches greedy NMS
+    i = scores.argsort(descending=True)
+    if not len(i):
+        return i
+    iou = box_iou(boxes[i], boxes[i]).triu_(diagonal=1)
+    c = iou
+    for _ in range(len(i)):
+        a = c
+        keep = (a.max(0)[0] <= iou_thres).float()  # boxes not suppressed by any kept box
+        c = iou * keep[:, None]  # only kept boxes can suppress
+        if a.equal(c):
+            break
+    return i[c.max(0)[0] <= iou_thres]
+
+
+def matrix_nms(boxes, scores, iou_thres, sigma=2.0):
+    # Matrix-NMS https://arxiv.org/abs/2003.10152, gaussian soft decay of every score by its overlapping boxes.
+    # Nothing is removed: scores are decayed in place and the caller drops those that fall below conf_thres.
+    # iou_thres is unused and only kept for a common engine signature.
+    i = scores.argsort(descending=True)
+    if not len(i):
+        return i
+    iou = box_iou(boxes[i], boxes[i]).triu_(diagonal=1)
+    compensate = iou.max(0)[0][:, None]  # how much each suppressing box was itself suppressed
+    decay = (torch.exp(-sigma * iou ** 2) / torch.exp(-sigma * compensate ** 2)).min(0)[0]
+    scores[i] *= decay
+    return i[scores[i].argsort(descending=True)]
+
+
+def numpy_nms(boxes, scores, iou_thres):
+    # Greedy NMS in numpy, for runtimes where torchvision ops are missing (utils.general imports without torchvision)
+    b, s = boxes.detach().cpu().double().numpy(), scores.detach().cpu().double().numpy()
+    x1, y1, x2, y2 = b.T
+    area = (x2 - x1) * (y2 - y1)
+    order, keep = s.argsort()[::-1], []
+    while order.size:
+        j, order = order[0], order[1:]
+        keep.append(j)
+        w = (np.minimum(x2[j], x2[order]) - np.maximum(x1[j], x1[order])).clip(0)
+        h = (np.minimum(y2[j], y2[order]) - np.maximum(y1[j], y1[order])).clip(0)
+        inter = w * h
+        order = order[inter / (area[j] + area[order] - inter) <= iou_thres]
+    return torch.tensor(keep, dtype=torch.long, device=boxes.device)
+
+
+# NMS engines: f(boxes(n,4) xyxy, scores(n), iou_thres) -> kept indices (k) sorted by decreasing score.
+NMS_ENGINES = {'fast': fast_nms,
+               'cluster': cluster_nms,
+               'matrix': matrix_nms,
+               'numpy': numpy_nms}
+if torchvision is not None:
+    NMS_ENGINES['torchvision'] = lambda boxes, scores, iou_thres: torchvision.ops.nms(boxes, scores, iou_thres)
+NMS_DEFAULT = 'torchvision' if torchvision is not None else 'numpy'  # greedy NMS
+MATRIX_NMS = 'fast', 'cluster', 'matrix'  # engines that build an (n,n) IoU matrix
+MAX_NMS_MATRIX = 3000  # maximum number of boxes per image into a MATRIX_NMS engine (3000^2 IoU = 36 MB)
+
+
 def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=()):
+                        labels=(), engine=NMS_DEFAULT):
     """Runs Non-Maximum Suppression (NMS) on inference results
 
     Returns:
@@ -618,7 +690,7 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     # Settings
     min_wh, max_wh = 2, 4096  # (pixels) minimum and maximum box width and height
     max_det = 300  # maximum number of detections per image
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
+    max_nms = MAX_NMS_MATRIX if engine in MATRIX_NMS else 30000  # maximum number of boxes into NMS
     time_limit = 10.0  # seconds to quit after
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
@@ -680,7 +752,8 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
         # Batched NMS
         c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
         boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
+        i = NMS_ENGINES[engine](boxes, scores, iou_thres)  # NMS
+        i = i[x[i, 4] > conf_thres]  # scores decayed by soft engines
         if i.shape[0] > max_det:  # limit detections
             i = i[:max_det]
         if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
@@ -699,8 +772,91 @@ def non_max_suppression(prediction, conf_thres=0.25, iou_thres=0.45, classes=Non
     return output
 
 
+def non_max_suppression_batched(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False,
+                                multi_label=False, labels=(), engine=NMS_DEFAULT):
+    """Runs Non-Maximum Suppression (NMS) on a whole batch of inference results at once
+
+    Returns:
+         list of detections, on (n,6) tensor per image [xyxy, conf, cls]
+    """
+
+    bs = prediction.shape[0]  # batch size
+    nc = prediction.shape[2] - 5  # number of classes
+
+    # Settings
+    max_wh = 4096  # (pixels) maximum box width and height
+    max_det = 300  # maximum number of detections per image
+    max_nms = MAX_NMS_MATRIX if engine in MATRIX_NMS else 30000  # maximum number of boxes per image into NMS
+    multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
+
+    b, k = (prediction[..., 4] > conf_thres).nonzero(as_tuple=True)  # image index, candidate index
+    x = prediction[b, k]  # candidates of all images (n,no)
+
+    # Cat apriori labels if autolabelling
+    if labels and sum(len(l) for l in labels):
+        l = torch.cat([l for l in labels if len(l)], 0)
+        v = torch.zeros((len(l), nc + 5), device=x.device)
+        v[:, :4] = l[:, 1:5]  # box
+        v[:, 4] = 1.0  # conf
+        v[range(len(l)), l[:, 0].long() + 5] = 1.0  # cls
+        x = torch.cat((x, v), 0)
+        b = torch.cat((b, torch.cat([torch.full((len(l),), i, device=b.device) for i, l in enumerate(labels)])), 0)
+
+    # Compute conf
+    if nc == 1:
+        scores = x[:, 4:5]  # for models with one class, cls_conf is always 0.5, so conf = obj_conf
+    else:
+        x[:, 5:] *= x[:, 4:5]  # conf = obj_conf * cls_conf
+        scores = x[:, 5:]
+
+    # Box (center x, center y, width, height) to (x1, y1, x2, y2)
+    box = xywh2xyxy(x[:, :4])
+
+    # Detections matrix nx6 (xyxy, conf, cls)
+    if multi_label:
+        i, j = (scores > conf_thres).nonzero(as_tuple=False).T
+        x, b = torch.cat((box[i], scores[i, j, None], j[:, None].float()), 1), b[i]
+    else:  # best class only
+        conf, j = scores.max(1, keepdim=True)
+        i = conf.view(-1) > conf_thres
+        x, b = torch.cat((box, conf, j.float()), 1)[i], b[i]
+
+    # Filter by class
+    if classes is not None:
+        i = (x[:, 5:6] == torch.tensor(classes, device=x.device)).any(1)
+        x, b = x[i], b[i]
+
+    # Keep the max_nms most confident boxes of each image
+    if x.shape[0] > max_nms:
+        i = x[:, 4].argsort(descending=True)
+        i = i[b[i].sort(stable=True)[1]]  # by image, then by confidence
+        x, b = x[i], b[i]
+        n = torch.bincount(b, minlength=bs)
+        i = torch.arange(len(b), device=b.device) - (n.cumsum(0) - n)[b] < max_nms  # rank within image
+        x, b = x[i], b[i]
+
+    # Batched NMS, one group per (image, class)
+    c = b if agnostic else b * nc + x[:, 5].long()  # groups
+    if engine == 'torchvision':
+        i = torchvision.ops.batched_nms(x[:, :4], x[:, 4], c, iou_thres)  # sorted by decreasing confidence
+    else:  # one call per image, so (n,n) IoU matrices stay per image instead of spanning the batch
+        boxes = x[:, :4] + x[:, 5:6] * (0 if agnostic else max_wh)  # boxes offset by class, as in non_max_suppression
+        i = [b[:0]]
+        for k in b.unique().tolist():
+            j = (b == k).nonzero(as_tuple=True)[0]
+            scores = x[j, 4]
+            i.append(j[NMS_ENGINES[engine](boxes[j], scores, iou_thres)])
+            x[j, 4] = scores  # scores decayed in place by soft engines
+        i = torch.cat(i)
+        i = i[x[i, 4] > conf_thres]  # scores decayed by soft engines
+    i = i[b[i].sort(stable=True)[1]]  # by image, then by confidence
+    n = torch.bincount(b[i], minlength=bs)
+    i = i[torch.arange(len(i), device=i.device) - (n.cumsum(0) - n)[b[i]] < max_det]  # limit detections
+    return list(x[i].split(n.clamp(max=max_det).tolist()))
+
+
 def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes=None, agnostic=False, multi_label=False,
-                        labels=(), kpt_label=False, nc=None, nkpt=None):
+                        labels=(), kpt_label=False, nc=None, nkpt=None, engine=NMS_DEFAULT):
     """Runs Non-Maximum Suppression (NMS) on inference results
 
     Returns:
@@ -713,7 +869,7 @@ def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes
     # Settings
     min_wh, max_wh = 2, 4096  # (pixels) minimum and maximum box width and height
     max_det = 300  # maximum number of detections per image
-    max_nms = 30000  # maximum number of boxes into torchvision.ops.nms()
+    max_nms = MAX_NMS_MATRIX if engine in MATRIX_NMS else 30000  # maximum number of boxes into NMS
     time_limit = 10.0  # seconds to quit after
     redundant = True  # require redundant detections
     multi_label &= nc > 1  # multiple labels per box (adds 0.5ms/img)
@@ -777,7 +933,8 @@ def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes
         # Batched NMS
         c = x[:, 5:6] * (0 if agnostic else max_wh)  # classes
         boxes, scores = x[:, :4] + c, x[:, 4]  # boxes (offset by class), scores
-        i = torchvision.ops.nms(boxes, scores, iou_thres)  # NMS
+        i = NMS_ENGINES[engine](boxes, scores, iou_thres)  # NMS
+        i = i[x[i, 4] > conf_thres]  # scores decayed by soft engines
         if i.shape[0] > max_det:  # limit detections
             i = i[:max_det]
         if merge and (1 < n < 3E3):  # Merge NMS (boxes merged using weighted mean)
@@ -796,6 +953,20 @@ def non_max_suppression_kpt(prediction, conf_thres=0.25, iou_thres=0.45, classes
     return output
 
 
+def merge_tiles(pred, offsets, iou_thres=0.45, agnostic=False, extra=None, max_det=300, engine=NMS_DEFAULT,
+                conf_thres=0.0):
+    # Merge per-tile detections pred[i](n,6) into one (n,6) tensor in full-image pixels with cross-tile NMS.
+    # offsets(n,2) are tile (x, y) origins, extra is an optional (n,6) set already in full-image pixels
+    d = [p[:, :4] + torch.tensor(o, device=p.device, dtype=p.dtype).repeat(2) for p, o in zip(pred, offsets)]
+    x = torch.cat([torch.cat((b, p[:, 4:]), 1) for b, p in zip(d, pred)] + ([extra] if extra is not None else []), 0)
+    if not len(x):
+        return x
+    c = x[:, 5:6] * (0 if agnostic else x[:, :4].max() + 1)  # classes
+    i = NMS_ENGINES[engine](x[:, :4] + c, x[:, 4], iou_thres)  # same object seen by several tiles
+    i = i[x[i, 4] > conf_thres]  # scores decayed by soft engines
+    return x[i[:max_det]]
+
+
 def strip_optimizer(f='best.pt', s=''):  # from utils.general import *; strip_optimizer()
     # Strip optimizer from 'f' to finalize training, optionally save as 's'
     x = torch.load(f, map_location=torch.device('cpu'))
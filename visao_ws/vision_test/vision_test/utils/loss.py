@@ -1,5 +1,7 @@
 # Loss functions
 
+from collections import OrderedDict
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -583,6 +585,7 @@ class ComputeLossOTA:
         device = targets.device
         lcls, lbox, lobj = torch.zeros(1, device=device), torch.zeros(1, device=device), torch.zeros(1, device=device)
         bs, as_, gjs, gis, targets, anchors = self.build_targets(p, targets, imgs)
+        self.assigned = bs, as_, gjs, gis, anchors  # reused by ComputeLossDistill
         pre_gen_gains = [torch.tensor(pp.shape, device=device)[[3, 2, 3, 2]] for pp in p] 
     
 
@@ -846,6 +849,62 @@ class ComputeLossOTA:
         return indices, anch
     
 
+class ComputeLossDistill(ComputeLossOTA):
+    # OTA loss plus distillation from a frozen teacher on objectness, class logits and the OTA-assigned boxes
+    def __init__(self, model, teacher, weight=1.0, cache=0, autobalance=False):
+        super(ComputeLossDistill, self).__init__(model, autobalance)
+        t = teacher.model[-1]  # teacher Detect() module
+        assert t.nc == self.nc and t.nl == self.nl and t.na == self.na, 'teacher and student heads must match'
+        assert torch.equal(t.stride.cpu(), self.stride.cpu()), 'teacher and student strides must match'
+        self.tanchors = t.anchors  # teacher anchors (grid units), slot a of the teacher is matched to slot a
+        self.teacher = teacher.eval()
+        for v in self.teacher.parameters():
+            v.requires_grad = False
+        self.weight = weight
+        self.cache, self.cache_size = OrderedDict(), cache  # teacher outputs per dataset image, LRU
+
+    def teacher_forward(self, imgs, keys=None):
+        # Raw teacher predictions [(bs,na,ny,nx,no)] per level, cached per key (one per dataset image) when cache_size > 0.
+        # Only valid when the loader returns the same image for a key every epoch, i.e. no random augmentation
+        with torch.no_grad():
+            if not self.cache_size or keys is None:
+                return [x.float() for x in self.teacher(imgs)[1]]
+            keys = [f'{k} {tuple(imgs.shape[2:])}' for k in keys]  # no GPU sync, unlike hashing image content
+            miss = [j for j, k in enumerate(keys) if k not in self.cache]
+            if miss:
+                out = self.teacher(imgs[miss])[1]
+                for n, j in enumerate(miss):
+                    self.cache[keys[j]] = [x[n].half().cpu() for x in out]
+            for k in keys:
+                self.cache.move_to_end(k)
+            tp = [torch.stack([self.cache[k][i] for k in keys]).to(imgs.device).float() for i in range(self.nl)]
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)  # drop least recently used image
+            return tp
+
+    def __call__(self, p, targets, imgs, keys=None):  # predictions, targets, model, teacher cache keys
+        loss, loss_items = super(ComputeLossDistill, self).__call__(p, targets, imgs)
+        device = targets.device
+        tp = self.teacher_forward(imgs, keys)
+        ldbox, ldobj, ldcls = torch.zeros(1, device=device), torch.zeros(1, device=device), torch.zeros(1, device=device)
+        bs, as_, gjs, gis, anchors = self.assigned
+        for i, (pi, ti) in enumerate(zip(p, tp)):
+            ldobj += F.binary_cross_entropy_with_logits(pi[..., 4], ti[..., 4].sigmoid()) * self.balance[i]
+            b, a, gj, gi = bs[i], as_[i], gjs[i], gis[i]  # image, anchor, gridy, gridx
+            if b.shape[0]:
+                ps, ts = pi[b, a, gj, gi], ti[b, a, gj, gi]  # student and teacher at the assigned cells
+                pbox = torch.cat((ps[:, :2].sigmoid() * 2. - 0.5, (ps[:, 2:4].sigmoid() * 2) ** 2 * anchors[i]), 1)
+                ta = self.tanchors[i].to(device)[a]
+                tbox = torch.cat((ts[:, :2].sigmoid() * 2. - 0.5, (ts[:, 2:4].sigmoid() * 2) ** 2 * ta), 1)
+                ldbox += (1.0 - bbox_iou(pbox.T, tbox, x1y1x2y2=False, CIoU=True)).mean()
+                if self.nc > 1:  # cls loss (only if multiple classes)
+                    ldcls += F.binary_cross_entropy_with_logits(ps[:, 5:], ts[:, 5:].sigmoid())
+
+        ld = (ldbox * self.hyp['box'] + ldobj * self.hyp['obj'] + ldcls * self.hyp['cls']) * self.weight
+        loss_items[3:] += ld.detach()  # total
+        return loss + ld * p[0].shape[0], loss_items
+
+
 class ComputeLossBinOTA:
     # Compute losses
     def __init__(self, model, autobalance=False):
@@ -1,6 +1,7 @@
 # YOLOR PyTorch utils
 
 import datetime
+import hashlib
 import logging
 import math
 import os
@@ -15,7 +16,11 @@ import torch
 import torch.backends.cudnn as cudnn
 import torch.nn as nn
 import torch.nn.functional as F
-import torchvision
+
+try:
+    import torchvision  # only for load_classifier()
+except ImportError:
+    torchvision = None
 
 try:
     import thop  # for FLOPS computation
@@ -93,6 +98,20 @@ def time_synchronized():
     return time.time()
 
 
+def set_threads(threads=None, interop_threads=None, cores=None):
+    # Pin the calling thread to cores and size torch's thread pools, call at startup before any inference
+    # Threads spawned afterwards (torch's OpenMP pool, cv2 workers) inherit the affinity of the calling thread
+    if cores and hasattr(os, 'sched_setaffinity'):  # Linux only
+        os.sched_setaffinity(0, cores)
+    if interop_threads:
+        try:
+            torch.set_num_interop_threads(interop_threads)
+        except RuntimeError:  # can only be set once, before any inter-op parallel work has started
+            logger.warning(f'set_threads: inter-op threads already fixed at {torch.get_num_interop_threads()}')
+    if threads:
+        torch.set_num_threads(threads)
+
+
 def profile(x, ops, n=100, device=None):
     # profile a pytorch module or list of modules. Example usage:
     #     x = torch.randn(16, 3, 640, 640)  # input
@@ -371,4 +390,59 @@ class TracedModel(nn.Module):
     def forward(self, x, augment=False, profile=False):
         out = self.model(x)
         out = self.detect_layer(out)
-        return out
\ No newline at end of file
+        return out
+
+
+class CompiledModel(nn.Module):
+    # Inference graph of a fused model, compiled once per input shape and cached on disk
+    # 'jit': trace (no Python layer routing) and freeze (constant folding), optionally optimize_for_inference (mkldnn)
+    # 'inductor': torch.compile (op fusion by codegen), cached by inductor itself under cache_dir
+    def __init__(self, model=None, mode='jit', cache_dir='runs/compiled', optimize=False):
+        super(CompiledModel, self).__init__()
+        self.stride = model.stride
+        self.names = model.names
+        self.model = model.eval()
+        self.mode = mode
+        self.optimize = optimize  # slower than the frozen graph on some CPUs, profile before enabling
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.graphs = {}  # input shape: compiled module
+        if getattr(model.model[-1], 'gate_conf', None) is not None:
+            logger.warning('CompiledModel: gated decode has data-dependent shapes, disabled')
+            model.model[-1].gate_conf = None
+        if mode == 'inductor':
+            os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', str(self.cache_dir.resolve()))
+            self.compiled = torch.compile(self.model)
+
+    def key(self, x):
+        # Weights, head flags, input shape/dtype/device and torch version identify a compiled graph
+        h = hashlib.sha1()
+        for v in self.model.state_dict().values():
+            h.update(v.detach().cpu().numpy().tobytes())
+        m = self.model.model[-1]
+        h.update(str((tuple(x.shape), x.dtype, x.device.type, torch.__version__, getattr(m, 'fused_decode', False),
+                      getattr(m, 'include_nms', False), getattr(m, 'end2end', False), getattr(m, 'concat', False))).encode())
+        return h.hexdigest()[:16]
+
+    def build(self, x):
+        f = self.cache_dir / f'{self.key(x)}.torchscript'
+        if f.exists():
+            g = torch.jit.load(str(f), map_location=x.device)
+        else:
+            with torch.no_grad():
+                self.model(x)  # build Detect grids eagerly so they are folded into the graph as constants
+                g = torch.jit.freeze(torch.jit.trace(self.model, x, strict=False))
+            g.save(str(f))  # frozen graph, optimize_for_inference output does not serialize
+            logger.info(f'CompiledModel: {tuple(x.shape)} graph saved to {f}')
+        return torch.jit.optimize_for_inference(g) if self.optimize else g
+
+    def forward(self, x, augment=False, profile=False):
+        if augment or profile:  # test-time augmentation and profiling are not in the compiled graph, run eager
+            return self.model(x, augment=augment, profile=profile)
+        if self.mode == 'inductor':
+            return self.compiled(x)
+        shape = tuple(x.shape)
+        if shape not in self.graphs:
+            self.graphs[shape] = self.build(x)
+        return self.graphs[shape](x)
+